@@ -11,6 +11,8 @@ from src_watermark.xsir.watermark import (
 from src_watermark.kgw.extended_watermark_processor import (
     WatermarkDetector as KGWDetector
 )
+from src_watermark.kgw.ngram_cache import NgramGreennessCache
+from src_watermark.kgw.alternative_prf_schemes import set_hashint_table_cache
 from src_watermark.uw.detect import Detector as UWDetector
 
 from utils import read_jsonl, append_jsonl
@@ -21,6 +23,13 @@ def get_length(text, tokenizer):
 def is_nan(nan):
     return nan != nan
 
+def write_result(output_file, dd, detect_res):
+    z_score = detect_res["z_score"]
+    biases = detect_res["biases"] if "biases" in detect_res else None
+    if is_nan(z_score):
+        z_score = None
+    append_jsonl(output_file, {"z_score": z_score, "prompt": dd["prompt"], "response": dd["response"], "biases": biases})
+
 def main(args):
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     tokenizer = AutoTokenizer.from_pretrained(args.base_model, trust_remote_code=True)
@@ -46,21 +55,27 @@ def main(args):
         else:
             raise ValueError(f"Incorrect watermark type: {args.watermark_type}")
     elif args.watermark_method == "kgw":
+        if args.hashint_table_cache is not None:
+            set_hashint_table_cache(args.hashint_table_cache)
         watermark_detector = KGWDetector(
             vocab=list(tokenizer.get_vocab().values()),
             gamma=args.gamma, # should match original setting
             seeding_scheme=args.seeding_scheme, # should match original setting
+            greenlist_table=args.greenlist_table, # should match original setting
             device=device, # must match the original rng device type
             tokenizer=tokenizer,
             z_threshold=4.0,
             normalizers=[],
             ignore_repeated_ngrams=True,
+            ngram_cache=NgramGreennessCache(max_entries=args.ngram_cache_size, path=args.ngram_cache_path),
         )
     elif args.watermark_method == "uw":
         model = AutoModelForCausalLM.from_pretrained(args.base_model, device_map="auto", trust_remote_code=True)
         watermark_detector = UWDetector(
             model=model,
-            tokenizer=tokenizer
+            tokenizer=tokenizer,
+            code_scheme=args.uw_code_scheme,
+            memory_budget=int(args.uw_memory_budget_mb * 2**20) if args.uw_memory_budget_mb else None
         )
     else:
         raise ValueError(f"Incorrect watermark method: {args.watermark_method}")
@@ -75,20 +90,28 @@ def main(args):
     # Detect
     detect_data = detect_data[len(done_data):]
     with torch.no_grad():
-        for dd in tqdm.tqdm(detect_data):
-            try:
-                detect_res = watermark_detector.detect(dd["response"])
-            except ValueError as e:
-                if "Must have at least" in str(e):
-                    # Input is too short
-                    detect_res = {"z_score": None}
-                else:
-                    raise e
-            z_score = detect_res["z_score"]
-            biases = detect_res["biases"] if "biases" in detect_res else None
-            if is_nan(z_score):
-                z_score = None
-            append_jsonl(args.output_file, {"z_score": z_score, "prompt": dd["prompt"], "response": dd["response"], "biases": biases})
+        if args.detect_batch_size > 0:
+            # Stream the records through the batched detector, results are written in input order
+            for start in tqdm.tqdm(range(0, len(detect_data), args.detect_batch_size)):
+                batch_data = detect_data[start:start + args.detect_batch_size]
+                batch_res = watermark_detector.detect_batch([dd["response"] for dd in batch_data], batch_size=args.detect_batch_size)
+                for dd, detect_res in zip(batch_data, batch_res):
+                    write_result(args.output_file, dd, detect_res)
+        else:
+            for dd in tqdm.tqdm(detect_data):
+                try:
+                    detect_res = watermark_detector.detect(dd["response"])
+                except ValueError as e:
+                    if "Must have at least" in str(e):
+                        # Input is too short
+                        detect_res = {"z_score": None}
+                    else:
+                        raise e
+                write_result(args.output_file, dd, detect_res)
+
+    if args.watermark_method == "kgw":
+        watermark_detector.ngram_cache.close()
+        print(f"Ngram cache: {watermark_detector.ngram_cache.stats()}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Compare the z-scores of strings in detect_file.')
@@ -113,6 +136,15 @@ if __name__ == "__main__":
     # KGW
     parser.add_argument('--gamma', type=float, default=0.25)
     parser.add_argument('--seeding_scheme', type=str, default="minhash")
+    parser.add_argument('--ngram_cache_size', type=int, default=2**18, help="Max number of ngram greenness entries kept in memory")
+    parser.add_argument('--ngram_cache_path', type=str, default=None, help="Optional sqlite file backing the ngram cache, can be shared by parallel detect workers and across runs")
+    parser.add_argument('--greenlist_table', type=str, default=None, help="Precomputed greenlist table for context_width=1 schemes (see src_watermark/kgw/greenlist_table.py)")
+    parser.add_argument('--hashint_table_cache', type=str, default=None, help="Memory-mapped on-disk copy of the KGW hashint table, created on first use (also settable with KGW_HASHINT_TABLE_CACHE)")
+    parser.add_argument('--uw_code_scheme', type=str, default="sha256-v1", choices=["sha256-v1", "philox-v1"], help="Derivation of the UW watermark codes, must match generation")
+    parser.add_argument('--uw_memory_budget_mb', type=float, default=None, help="Working memory budget (MB) of UW robust LLR scoring, scores the sequence in chunks that fit (default: unchunked)")
+
+    # Detection
+    parser.add_argument('--detect_batch_size', type=int, default=0, help="Detect this many records at once and fill embedder/LLM batches of this size across documents (0: one record at a time)")
 
     args = parser.parse_args()
 
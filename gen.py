@@ -92,7 +92,8 @@ def main(args):
             watermark_model = XSIRWindow(
                 device,
                 args.window_size,
-                tokenizer
+                tokenizer,
+                greenlist_cache_size=args.window_cache_size
             )
             logits_processor = XSIRLogitsProcessor(watermark_model)
         elif args.watermark_type == "context":
@@ -103,9 +104,14 @@ def main(args):
                 mapping_file=args.mapping_file,
                 delta=args.delta,
                 transform_model_path=args.transform_model,
-                embedding_model=args.embedding_model
+                embedding_model=args.embedding_model,
+                bias_cache_size=args.bias_cache_size
+            )
+            logits_processor = XSIRLogitsProcessor(
+                watermark_model,
+                track_context=args.track_context or args.prefetch_top_k > 0,
+                prefetch_top_k=args.prefetch_top_k
             )
-            logits_processor = XSIRLogitsProcessor(watermark_model)
         else:
             raise ValueError(f"Incorrect watermark type: {args.watermark_type}")
     elif args.watermark_method == "kgw":
@@ -113,13 +119,18 @@ def main(args):
             vocab=list(tokenizer.get_vocab().values()),
             gamma=args.gamma,
             delta=args.delta,
-            seeding_scheme=args.seeding_scheme
+            seeding_scheme=args.seeding_scheme,
+            greenlist_table=args.greenlist_table,
+            greenlist_cache_bytes=int(args.greenlist_cache_mb * 2**20),
+            tail_rule=args.tail_rule,
+            rejection_k=args.rejection_k
         )
     elif args.watermark_method == "uw":
         logits_processor = UWLogitsProcessor(
             b"42",
             Delta_Reweight(),
             PrevN_ContextCodeExtractor(5),
+            code_scheme=args.uw_code_scheme,
         )
     elif args.watermark_method == "no":
         logits_processor = None
@@ -164,6 +175,13 @@ def main(args):
                 # Append to output file
                 append_jsonl(args.output_file, {"prompt": batch_prompts[i], "response": new_text})
 
+    if args.watermark_method in ["xsir", "sir"] and args.watermark_type == "context":
+        print(f"Bias cache: {watermark_model.bias_cache.stats()}")
+    if args.watermark_method in ["xsir", "sir"] and args.watermark_type == "window":
+        print(f"Greenlist cache: {watermark_model.greenlist_cache.stats()}")
+    if args.watermark_method == "kgw" and args.greenlist_cache_mb > 0:
+        print(f"Greenlist cache: {logits_processor.greenlist_cache_stats()}")
+
 if __name__ == "__main__": 
     parser = argparse.ArgumentParser(description='Generate with watermarking')
     # Model
@@ -185,10 +203,21 @@ if __name__ == "__main__":
     parser.add_argument('--mapping_file', type=str, default="mapping.json")
     parser.add_argument('--transform_model', type=str, default="model/transform_model_x-sbert.pth")
     parser.add_argument('--embedding_model', type=str, default="paraphrase-multilingual-mpnet-base-v2")
+    parser.add_argument('--track_context', action="store_true", help="Track generated tokens incrementally instead of re-tokenizing the prefix (the context excludes the prompt, as in detection)")
+    parser.add_argument('--prefetch_top_k', type=int, default=0, help="Embed the contexts of the top-k next-token candidates in the background before a chunk closes (implies --track_context)")
+    parser.add_argument('--bias_cache_size', type=int, default=256, help="Number of context biases kept in the LRU cache (0 disables it)")
+    parser.add_argument('--window_cache_size', type=int, default=64, help="Number of window green masks ([vocab_size] each) kept in the LRU cache (0 disables it)")
 
     # KGW
     parser.add_argument('--gamma', type=float, default=0.25)
     parser.add_argument('--seeding_scheme', type=str, default="minhash")
+    parser.add_argument('--tail_rule', type=str, default="fixed_compute", choices=["fixed_compute", "fixed_score", "fixed_list_length", "none"], help="Early-stopping rule of selfhash rejection sampling")
+    parser.add_argument('--rejection_k', type=int, default=41, help="Number of top candidates checked by selfhash rejection sampling")
+    parser.add_argument('--greenlist_table', type=str, default=None, help="Precomputed greenlist table for context_width=1 schemes (see src_watermark/kgw/greenlist_table.py)")
+    parser.add_argument('--greenlist_cache_mb', type=float, default=0, help="Device memory budget (MB) of the LRU cache of KGW permutation greenlists by seed (0 disables it)")
+
+    # UW
+    parser.add_argument('--uw_code_scheme', type=str, default="sha256-v1", choices=["sha256-v1", "philox-v1"], help="Derivation of the UW watermark codes (philox-v1: batched on-device counter-based RNG)")
 
     # Generation
     parser.add_argument('--batch_size', type=int, default=4)
@@ -0,0 +1,13 @@
+"""Integer hashing primitives shared by the watermarks, on int64 tensors holding uint32 values."""
+
+import torch
+
+
+def fmix32(x: torch.LongTensor) -> torch.LongTensor:
+    """murmur3 32-bit finalizer on int64 tensors holding uint32 values (products wrap, only the low 32 bits are kept)."""
+    x = x ^ (x >> 16)
+    x = (x * 0x85EBCA6B) & 0xFFFFFFFF
+    x = x ^ (x >> 13)
+    x = (x * 0xC2B2AE35) & 0xFFFFFFFF
+    x = x ^ (x >> 16)
+    return x
@@ -20,22 +20,29 @@ extended_watermark_processor.py
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+
+import numpy as np
 import torch
 from itertools import combinations
 from functools import cache
 
+from ..hashing import fmix32
+
 # Key properties of a hashing scheme
 props = {
     "prf_type": str,  # string name of the underlying PRF mapping multiple token ids to a random seed
     "context_width": int,  # this is h in the paper, how many previous tokens should be considered for each PRF
     "self_salt": bool,  # Use the rules laid in robust-watermarking to use the token itself to seed and possibly reject its own list
     "hash_key": int,  # integer, large prime, used to move seed away from low-entrop bit sequences in PRF chosen above
+    "greenlist_type": str,  # "permutation" draws a randperm of the vocabulary from the seed, "hash" decides membership as hash(seed, token) < gamma * 2^32
 }
 
 
 def seeding_scheme_lookup(seeding_scheme: str):
     if not isinstance(seeding_scheme, str):
         raise ValueError("Seeding scheme should be a string summarizing the procedure.")
+    greenlist_type = "permutation"
     if seeding_scheme == "simple_1" or seeding_scheme == "lefthash":
         # Default, simple bigram hash  # alias for ff-additive_prf-1-False-15485863
         prf_type = "additive_prf"
@@ -57,9 +64,20 @@ def seeding_scheme_lookup(seeding_scheme: str):
         context_width = 5
         self_salt = False
         hash_key = 15485863
+    elif seeding_scheme == "hashmember":
+        # minhash context, but green membership is hash(seed, token) < gamma * 2^32 instead of a permutation of the vocabulary
+        prf_type = "minhash_prf"
+        context_width = 4
+        self_salt = False
+        hash_key = 15485863
+        greenlist_type = "hash"
     elif seeding_scheme.startswith("ff"):  # freeform seeding scheme API - only use for experimenting
         # expects strings of the form ff-additive_prf-4-True-hash or ff-additive_prf-5-True (hash key is optional)
+        # a trailing -hashmember selects hash membership greenlists, e.g. ff-minhash_prf-4-False-15485863-hashmember
         split_scheme = seeding_scheme.split("-")
+        if split_scheme[-1] == "hashmember":
+            greenlist_type = "hash"
+            split_scheme = split_scheme[:-1]
         prf_type = str(split_scheme[1])
         context_width = int(split_scheme[2])
         self_salt = split_scheme[3] == "True"
@@ -71,7 +89,7 @@ def seeding_scheme_lookup(seeding_scheme: str):
         raise ValueError(f"Invalid seeding scheme name {seeding_scheme} given. Try  'simple_1'?")
 
     assert prf_type in prf_lookup.keys()
-    return prf_type, context_width, self_salt, hash_key
+    return prf_type, context_width, self_salt, hash_key, greenlist_type
 
 
 def multiplicative_prf(input_ids: torch.LongTensor, salt_key: int) -> int:
@@ -144,16 +162,131 @@ prf_lookup = {
     "position_prf": position_prf,
 }
 
-# Generate a global permute table once at startup
-rng = torch.Generator(device=torch.device("cpu"))
-rng.manual_seed(2971215073)  # fib47 is prime
+# Batched versions, mapping a [N, context_width] tensor of contexts to N PRF outputs in one tensor op on the device of
+# the contexts. They agree with the functions above (same int64 arithmetic). multiplicative_prf has no batched version,
+# its product is multiplied with salt_key in python integers, which do not wrap like int64 tensors.
+def additive_prf_batch(input_ids: torch.LongTensor, salt_key: int) -> torch.LongTensor:
+    return salt_key * input_ids.sum(dim=-1)
+
+
+def minfunc_prf_batch(input_ids: torch.LongTensor, salt_key: int) -> torch.LongTensor:
+    return salt_key * input_ids.min(dim=-1)[0]
+
+
+def simple_skip_prf_batch(input_ids: torch.LongTensor, salt_key: int, k=2) -> torch.LongTensor:
+    return hashint_on_device(salt_key * input_ids[:, ::k]).prod(dim=-1)
+
+
+def skipgram_prf_batch(input_ids: torch.LongTensor, salt_key: int) -> torch.LongTensor:
+    return hashint_on_device(salt_key * input_ids[:, 0])
+
+
+def anchored_skipgram_prf_batch(input_ids: torch.LongTensor, salt_key: int, anchor: int = -1) -> torch.LongTensor:
+    return hashint_on_device(salt_key * input_ids[:, 0]) * hashint_on_device(salt_key * input_ids[:, anchor])
+
+
+def minhash_prf_batch(input_ids: torch.LongTensor, salt_key: int) -> torch.LongTensor:
+    return hashint_on_device(salt_key * input_ids).min(dim=-1)[0]
+
+
+def anchored_minhash_prf_batch(input_ids: torch.LongTensor, salt_key: int, anchor: int = -1) -> torch.LongTensor:
+    return (salt_key * hashint_on_device(input_ids) * hashint_on_device(input_ids[:, anchor, None])).min(dim=-1)[0]
+
+
+def minskipgram_prf_batch(input_ids: torch.LongTensor, salt_key: int, k: int = 2) -> torch.LongTensor:
+    hashed = hashint_on_device(salt_key * input_ids)
+    pairs = torch.combinations(torch.arange(input_ids.shape[-1], device=input_ids.device), 2)
+    return (hashed[:, pairs[:, 0]] * hashed[:, pairs[:, 1]]).min(dim=-1)[0]
+
+
+def noncomm_prf_batch(input_ids: torch.LongTensor, salt_key: int, k: int = 2) -> torch.LongTensor:
+    key = torch.full(input_ids.shape[:1], salt_key, dtype=torch.long, device=input_ids.device)
+    for idx in range(input_ids.shape[-1]):
+        key = key * hashint_on_device(key * input_ids[:, idx])
+        key %= 2**32
+    return key
+
+
+def position_prf_batch(input_ids: torch.LongTensor, salt_key: int, k: int = 2) -> torch.LongTensor:
+    return (salt_key * input_ids * torch.arange(1, input_ids.shape[-1] + 1, device=input_ids.device)).sum(dim=-1)
+
+
+prf_batch_lookup = {
+    "additive_prf": additive_prf_batch,
+    "minfunc_prf": minfunc_prf_batch,
+    "simple_skip_prf": simple_skip_prf_batch,
+    "skipgram_prf": skipgram_prf_batch,
+    "anchored_skipgram_prf": anchored_skipgram_prf_batch,
+    "minhash_prf": minhash_prf_batch,
+    "anchored_minhash_prf": anchored_minhash_prf_batch,
+    "minskipgram_prf": minskipgram_prf_batch,
+    "noncomm_prf": noncomm_prf_batch,
+    "position_prf": position_prf_batch,
+}
+
+# Global permute table, built on first use (see get_fixed_table)
 table_size = 1_000_003
-fixed_table = torch.randperm(1_000_003, device=torch.device("cpu"), generator=rng)  # actually faster than I thought
+_fixed_table = None
+
+# Optional on-disk copy of the table as a raw int64 array. It is memory-mapped instead of recomputed, so short-lived
+# processes start faster and share the pages. Set with set_hashint_table_cache or the KGW_HASHINT_TABLE_CACHE variable.
+_table_cache_path = os.environ.get("KGW_HASHINT_TABLE_CACHE")
+
+
+def set_hashint_table_cache(path: str) -> None:
+    """Use (and create if missing) an on-disk copy of the hashint table at path, None disables the cache. Only takes
+    effect if the table has not been built yet."""
+    global _table_cache_path
+    _table_cache_path = path
+
+
+def _build_fixed_table() -> torch.LongTensor:
+    rng = torch.Generator(device=torch.device("cpu"))
+    rng.manual_seed(2971215073)  # fib47 is prime
+    return torch.randperm(table_size, device=torch.device("cpu"), generator=rng)  # actually faster than I thought
+
+
+def _load_fixed_table(path: str) -> torch.LongTensor:
+    if not os.path.exists(path) or os.path.getsize(path) != table_size * 8:
+        # write to a temporary file first, so concurrent workers never map a partially written table
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        _build_fixed_table().numpy().tofile(tmp_path)
+        os.replace(tmp_path, path)
+    # copy-on-write mapping, pages stay shared between processes as long as nobody writes to them
+    return torch.from_numpy(np.memmap(path, dtype=np.int64, mode="c", shape=(table_size,)))
+
+
+def get_fixed_table() -> torch.LongTensor:
+    global _fixed_table
+    if _fixed_table is None:
+        _fixed_table = _build_fixed_table() if _table_cache_path is None else _load_fixed_table(_table_cache_path)
+    return _fixed_table
 
 
 def hashint(integer_tensor: torch.LongTensor) -> torch.LongTensor:
     """Sane version, in the end we only need a small permutation table."""
-    return fixed_table[integer_tensor.cpu() % table_size] + 1  # minor cheat here, this function always return CPU values
+    return get_fixed_table()[integer_tensor.cpu() % table_size] + 1  # minor cheat here, this function always return CPU values
+
+
+# copies of the permutation table on the devices hashint_on_device has been called on
+_device_tables = {}
+
+
+def hashint_on_device(integer_tensor: torch.LongTensor) -> torch.LongTensor:
+    """hashint without the move to CPU, the permutation table is copied once to every device it is used on."""
+    device = integer_tensor.device
+    if device not in _device_tables:
+        _device_tables[device] = get_fixed_table().to(device)
+    return _device_tables[device][integer_tensor % table_size] + 1
+
+
+def membership_hash(seeds: torch.LongTensor, token_ids: torch.LongTensor) -> torch.LongTensor:
+    """Keyed hash of (seed, token) to a uint32 value, broadcasting seeds against token_ids on their device.
+    Both 32-bit halves of the (int64) seed are mixed in."""
+    seed_lo = seeds & 0xFFFFFFFF
+    seed_hi = (seeds >> 32) & 0xFFFFFFFF
+    x = fmix32(seed_lo ^ ((token_ids * 0x9E3779B1) & 0xFFFFFFFF))
+    return fmix32(x ^ seed_hi)
 
 
 def _hashint_avalanche_tensor(integer_tensor: torch.LongTensor):
@@ -15,18 +15,24 @@
 # limitations under the License.
 
 from __future__ import annotations
+import copy
 import collections
 from math import sqrt
 from itertools import chain, tee
-from functools import lru_cache
+from typing import Iterable, Iterator
 
+import numpy as np
 import scipy.stats
 import torch
+from numpy.lib.stride_tricks import sliding_window_view
 from tokenizers import Tokenizer
 from transformers import LogitsProcessor
 
 from .normalizers import normalization_strategy_lookup
-from .alternative_prf_schemes import prf_lookup, seeding_scheme_lookup
+from .alternative_prf_schemes import prf_lookup, prf_batch_lookup, seeding_scheme_lookup, membership_hash
+from .greenlist_table import GreenlistTable
+from .ngram_cache import NgramGreennessCache, default_ngram_cache
+from .greenlist_cache import GreenlistCache
 
 
 class WatermarkBase:
@@ -37,6 +43,8 @@ class WatermarkBase:
         delta: float = 2.0,
         seeding_scheme: str = "selfhash",  # simple default, find more schemes in alternative_prf_schemes.py
         select_green_tokens: bool = True,  # should always be the default if not running in legacy mode
+        greenlist_table: str = None,  # path of a precomputed table for context_width=1 schemes, see greenlist_table.py
+        greenlist_cache_bytes: int = 0,  # byte budget of the device LRU cache of permutation greenlists, 0 disables it
     ):
         # patch now that None could now maybe be passed as seeding_scheme
         if seeding_scheme is None:
@@ -54,43 +62,121 @@ class WatermarkBase:
         # Legacy behavior:
         self.select_green_tokens = select_green_tokens
 
+        # Precomputed, memory-mapped greenlists (no RNG work at all)
+        self.greenlist_table = None
+        if greenlist_table is not None:
+            self.greenlist_table = GreenlistTable(greenlist_table)
+            self.greenlist_table.validate(self)
+
+        # LRU cache of permutation greenlists by seed, repeated seeds skip the randperm entirely
+        self.greenlist_cache = GreenlistCache(max_bytes=greenlist_cache_bytes)
+
     def _initialize_seeding_scheme(self, seeding_scheme: str) -> None:
         """Initialize all internal settings of the seeding strategy from a colloquial, "public" name for the scheme."""
-        self.prf_type, self.context_width, self.self_salt, self.hash_key = seeding_scheme_lookup(seeding_scheme)
+        self.seeding_scheme = seeding_scheme
+        self.prf_type, self.context_width, self.self_salt, self.hash_key, self.greenlist_type = seeding_scheme_lookup(seeding_scheme)
 
-    def _seed_rng(self, input_ids: torch.LongTensor) -> None:
-        """Seed RNG from local context. Not batched, because the generators we use (like cuda.random) are not batched."""
+    def _get_prf_key(self, input_ids: torch.LongTensor) -> int:
+        """Raw PRF output of the local context."""
         # Need to have enough context for seed generation
         if input_ids.shape[-1] < self.context_width:
             raise ValueError(f"seeding_scheme requires at least a {self.context_width} token prefix to seed the RNG.")
 
-        prf_key = prf_lookup[self.prf_type](input_ids[-self.context_width :], salt_key=self.hash_key)
+        return prf_lookup[self.prf_type](input_ids[-self.context_width :], salt_key=self.hash_key)
+
+    def _seed_rng(self, input_ids: torch.LongTensor) -> None:
+        """Seed RNG from local context. Not batched, because the generators we use (like cuda.random) are not batched."""
+        prf_key = self._get_prf_key(input_ids)
         # enable for long, interesting streams of pseudorandom numbers: print(prf_key)
         self.rng.manual_seed(prf_key % (2**64 - 1))  # safeguard against overflow from long
 
-    def _get_greenlist_ids(self, input_ids: torch.LongTensor) -> torch.LongTensor:
-        """Seed rng based on local context width and use this information to generate ids on the green list."""
-        self._seed_rng(input_ids)
+    def _as_seed_tensor(self, prf_keys: list[int], device: torch.device) -> torch.LongTensor:
+        """PRF keys as an int64 tensor, Python ints are wrapped to 64 bit two's complement like torch arithmetic."""
+        return torch.as_tensor([(key + 2**63) % 2**64 - 2**63 for key in prf_keys], dtype=torch.long, device=device)
+
+    def _get_green_mask(self, seeds: torch.LongTensor) -> torch.BoolTensor:
+        """Hash membership greenlists (greenlist_type="hash") for a batch of seeds as a [len(seeds), vocab_size] mask,
+        built in one vectorized op without any permutation."""
+        token_ids = torch.arange(self.vocab_size, device=seeds.device)
+        return self._is_green(seeds[:, None], token_ids[None, :])
+
+    def _is_green(self, seeds: torch.LongTensor, token_ids: torch.LongTensor) -> torch.BoolTensor:
+        """O(1) hash membership test of token_ids under seeds (broadcasting)."""
+        threshold = int(self.gamma * 2**32)
+        hashed = membership_hash(seeds, token_ids)
+        if self.select_green_tokens:  # directly
+            return hashed < threshold
+        else:  # select green via red
+            return hashed >= 2**32 - threshold
+
+    def _get_prf_keys_tensor(self, input_ids: torch.LongTensor) -> torch.LongTensor:
+        """Raw PRF outputs for every row of a [batch_size, seq_len] batch as an int64 tensor on the device of input_ids.
+        PRFs with a batched version in prf_batch_lookup are evaluated in one tensor op without a host sync."""
+        if input_ids.shape[-1] < self.context_width:
+            raise ValueError(f"seeding_scheme requires at least a {self.context_width} token prefix to seed the RNG.")
+        if self.prf_type in prf_batch_lookup:
+            return prf_batch_lookup[self.prf_type](input_ids[:, -self.context_width :], salt_key=self.hash_key)
+        return self._as_seed_tensor([self._get_prf_key(input_seq) for input_seq in input_ids], device=input_ids.device)
+
+    def _get_prf_keys(self, input_ids: torch.LongTensor) -> list[int]:
+        """Raw PRF outputs for every row of a [batch_size, seq_len] batch."""
+        if self.prf_type in prf_batch_lookup:
+            return self._get_prf_keys_tensor(input_ids).tolist()
+        return [self._get_prf_key(input_seq) for input_seq in input_ids]
+
+    def _get_greenlist_ids_from_key(self, prf_key: int, device: torch.device) -> torch.LongTensor:
+        """Permutation greenlist of one PRF key."""
+        seed = prf_key % (2**64 - 1)  # safeguard against overflow from long
+        if self.greenlist_cache.max_bytes > 0:
+            cache_key = (seed, self.vocab_size, self.gamma, self.select_green_tokens, torch.device(device))
+            greenlist_ids = self.greenlist_cache.get(cache_key)
+            if greenlist_ids is not None:
+                return greenlist_ids
+
+        self.rng.manual_seed(seed)
 
         greenlist_size = int(self.vocab_size * self.gamma)
-        vocab_permutation = torch.randperm(self.vocab_size, device=input_ids.device, generator=self.rng)
+        vocab_permutation = torch.randperm(self.vocab_size, device=device, generator=self.rng)
         if self.select_green_tokens:  # directly
             greenlist_ids = vocab_permutation[:greenlist_size]  # new
         else:  # select green via red
             greenlist_ids = vocab_permutation[(self.vocab_size - greenlist_size) :]  # legacy behavior
+
+        if self.greenlist_cache.max_bytes > 0:
+            self.greenlist_cache.put(cache_key, greenlist_ids.clone())  # clone, the slice would keep the full permutation alive
         return greenlist_ids
 
+    def greenlist_cache_stats(self) -> dict:
+        return self.greenlist_cache.stats()
+
+    def _get_greenlist_ids(self, input_ids: torch.LongTensor) -> torch.LongTensor:
+        """Seed rng based on local context width and use this information to generate ids on the green list."""
+        if self.greenlist_table is not None:
+            self.greenlist_table.validate(self, device=input_ids.device)
+            return self.greenlist_table.get_mask(input_ids[-1:])[0].nonzero().squeeze(-1)
+        if self.greenlist_type == "hash":
+            seeds = self._get_prf_keys_tensor(input_ids[None, :])
+            return self._get_green_mask(seeds)[0].nonzero().squeeze(-1)
+
+        return self._get_greenlist_ids_from_key(self._get_prf_key(input_ids), device=input_ids.device)
+
 
 class WatermarkLogitsProcessor(WatermarkBase, LogitsProcessor):
     """LogitsProcessor modifying model output scores in a pipe. Can be used in any HF pipeline to modify scores to fit the watermark,
     but can also be used as a standalone tool inserted for any model producing scores inbetween model outputs and next token sampler.
     """
 
-    def __init__(self, *args, store_spike_ents: bool = False, **kwargs):
+    def __init__(self, *args, store_spike_ents: bool = False, tail_rule: str = "fixed_compute", rejection_k: int = 41, **kwargs):
         super().__init__(*args, **kwargs)
 
+        # Self-salted schemes: early-stopping rule and number of top candidates checked by rejection sampling
+        self.tail_rule = tail_rule
+        self.rejection_k = rejection_k
+
         self.store_spike_ents = store_spike_ents
+        # [batch_size, capacity] buffer on the scores device, the first _num_spike_steps columns are filled
         self.spike_entropies = None
+        self._num_spike_steps = 0
         if self.store_spike_ents:
             self._init_spike_entropies()
 
@@ -107,25 +193,42 @@ class WatermarkLogitsProcessor(WatermarkBase, LogitsProcessor):
             self.expected_gl_coef = 1.0
 
     def _get_spike_entropies(self):
-        spike_ents = [[] for _ in range(len(self.spike_entropies))]
-        for b_idx, ent_tensor_list in enumerate(self.spike_entropies):
-            for ent_tensor in ent_tensor_list:
-                spike_ents[b_idx].append(ent_tensor.item())
-        return spike_ents
+        if self.spike_entropies is None:
+            return []
+        # single device to host transfer of all stored steps
+        return self.spike_entropies[:, : self._num_spike_steps].tolist()
 
     def _get_and_clear_stored_spike_ents(self):
         spike_ents = self._get_spike_entropies()
         self.spike_entropies = None
+        self._num_spike_steps = 0
         return spike_ents
 
     def _compute_spike_entropy(self, scores):
-        # precomputed z value in init
+        # precomputed z value in init, scores can be a single row or a [batch_size, vocab_size] batch
         probs = scores.softmax(dim=-1)
         denoms = 1 + (self.z_value * probs)
         renormed_probs = probs / denoms
-        sum_renormed_probs = renormed_probs.sum()
+        sum_renormed_probs = renormed_probs.sum(dim=-1)
         return sum_renormed_probs
 
+    def _store_spike_entropies(self, scores: torch.FloatTensor, initial_capacity: int = 256) -> None:
+        """Write the spike entropies of one step of the whole batch into the next column of the buffer, the buffer
+        doubles its capacity when it is full. No host sync."""
+        spike_ents = self._compute_spike_entropy(scores)
+        if self.spike_entropies is None:
+            self.spike_entropies = torch.empty(len(spike_ents), initial_capacity, dtype=spike_ents.dtype, device=spike_ents.device)
+            self._num_spike_steps = 0
+        elif self.spike_entropies.shape[0] != len(spike_ents):
+            raise ValueError(
+                f"Stored spike entropies are for a batch of {self.spike_entropies.shape[0]} rows, got {len(spike_ents)} rows. "
+                "Call _get_and_clear_stored_spike_ents between batches."
+            )
+        if self._num_spike_steps == self.spike_entropies.shape[1]:
+            self.spike_entropies = torch.cat([self.spike_entropies, torch.empty_like(self.spike_entropies)], dim=1)
+        self.spike_entropies[:, self._num_spike_steps] = spike_ents
+        self._num_spike_steps += 1
+
     def _calc_greenlist_mask(self, scores: torch.FloatTensor, greenlist_token_ids) -> torch.BoolTensor:
         # Cannot lose loop, greenlists might have different lengths
         green_tokens_mask = torch.zeros_like(scores, dtype=torch.bool)
@@ -149,7 +252,7 @@ class WatermarkLogitsProcessor(WatermarkBase, LogitsProcessor):
         This is only a partial version of Alg.3 "Robust Private Watermarking", as it always assumes greedy sampling. It will still (kinda)
         work for all types of sampling, but less effectively.
         To work efficiently, this function can switch between a number of rules for handling the distribution tail.
-        These are not exposed by default.
+        __call__ uses the batched _score_rejection_sampling_batched, which exposes them through tail_rule and rejection_k.
         """
         sorted_scores, greedy_predictions = scores.sort(dim=-1, descending=True)
 
@@ -173,31 +276,88 @@ class WatermarkLogitsProcessor(WatermarkBase, LogitsProcessor):
                 pass  # do not break early
         return torch.as_tensor(final_greenlist, device=input_ids.device)
 
+    def _score_rejection_sampling_batched(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.BoolTensor:
+        """Batched version of _score_rejection_sampling, returns the green mask of the whole batch.
+        The top rejection_k candidates of every row are taken with topk, the PRF seeds of all (row, candidate) contexts
+        are computed together and consistency is checked for all candidates in one vectorized pass. rejection_k caps the
+        number of candidates for every tail_rule ("fixed_compute" checks exactly rejection_k=41 candidates like the
+        unbatched version)."""
+        batch_size = input_ids.shape[0]
+        k = min(self.rejection_k, scores.shape[-1])
+        top_scores, candidates = scores.topk(k, dim=-1)
+
+        # context of every candidate is the prefix with the candidate appended
+        prefix = input_ids[:, -(self.context_width - 1) :] if self.context_width > 1 else input_ids[:, :0]
+        candidate_contexts = torch.cat([prefix[:, None, :].expand(-1, k, -1), candidates[:, :, None].to(input_ids.device)], dim=-1)
+        candidate_contexts = candidate_contexts.reshape(batch_size * k, -1)
+        flat_candidates = candidates.reshape(-1).to(input_ids.device)
+
+        if self.greenlist_type == "hash":
+            is_green = self._is_green(self._get_prf_keys_tensor(candidate_contexts), flat_candidates)
+        else:
+            prf_keys = self._get_prf_keys(candidate_contexts)
+            candidates_of_key = {}
+            for idx, prf_key in enumerate(prf_keys):
+                candidates_of_key.setdefault(prf_key, []).append(idx)
+            # with self salt nearly every key is unique, so only one greenlist is kept alive at a time
+            is_green = torch.zeros(batch_size * k, dtype=torch.bool, device=input_ids.device)
+            for prf_key, idxs in candidates_of_key.items():
+                greenlist_ids = self._get_greenlist_ids_from_key(prf_key, device=input_ids.device)
+                idxs = torch.as_tensor(idxs, device=input_ids.device)
+                is_green[idxs] = torch.isin(flat_candidates[idxs], greenlist_ids)
+        is_green = is_green.reshape(batch_size, k).to(scores.device)
+
+        # optional early-stopping rules, expressed as masks over the sorted candidates
+        if self.tail_rule == "fixed_score":
+            considered = (top_scores[:, :1] - top_scores) <= self.delta
+            considered[:, 0] = True
+            is_green = is_green & considered
+        elif self.tail_rule == "fixed_list_length":
+            is_green = is_green & (torch.cumsum(is_green, dim=-1) <= 10)
+
+        green_tokens_mask = torch.zeros_like(scores, dtype=torch.bool)
+        green_tokens_mask.scatter_(1, candidates, is_green)
+        return green_tokens_mask
+
+    def _get_greenlist_mask_batched(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.BoolTensor:
+        """Green mask for the whole batch. The PRF seeds of all rows are computed together, rows sharing a seed share
+        one permutation draw (hash membership needs none), and the [B, V] mask is filled with a single scatter."""
+        green_tokens_mask = torch.zeros_like(scores, dtype=torch.bool)
+        if self.greenlist_table is not None:
+            self.greenlist_table.validate(self, device=input_ids.device)
+            green_tokens_mask[:, : self.vocab_size] = self.greenlist_table.get_mask(input_ids[:, -1])
+            return green_tokens_mask
+
+        if self.greenlist_type == "hash":
+            seeds = self._get_prf_keys_tensor(input_ids)
+            green_tokens_mask[:, : self.vocab_size] = self._get_green_mask(seeds)
+            return green_tokens_mask
+
+        prf_keys = self._get_prf_keys(input_ids)
+        unique_keys = {}
+        for prf_key in prf_keys:
+            if prf_key not in unique_keys:
+                unique_keys[prf_key] = len(unique_keys)
+        greenlists = torch.stack([self._get_greenlist_ids_from_key(prf_key, device=input_ids.device) for prf_key in unique_keys])
+        row_index = torch.as_tensor([unique_keys[prf_key] for prf_key in prf_keys], device=input_ids.device)
+        green_tokens_mask.scatter_(1, greenlists[row_index].to(scores.device), True)
+        return green_tokens_mask
+
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
         """Call with previous context as input_ids, and scores for next token."""
 
         # this is lazy to allow us to co-locate on the watermarked model's device
         self.rng = torch.Generator(device=input_ids.device) if self.rng is None else self.rng
 
-        # NOTE, it would be nice to get rid of this batch loop, but currently,
-        # the seed and partition operations are not tensor/vectorized, thus
-        # each sequence in the batch needs to be treated separately.
-
-        list_of_greenlist_ids = [None for _ in input_ids]  # Greenlists could differ in length
-        for b_idx, input_seq in enumerate(input_ids):
-            if self.self_salt:
-                greenlist_ids = self._score_rejection_sampling(input_seq, scores[b_idx])
-            else:
-                greenlist_ids = self._get_greenlist_ids(input_seq)
-            list_of_greenlist_ids[b_idx] = greenlist_ids
+        if self.self_salt:
+            green_tokens_mask = self._score_rejection_sampling_batched(input_ids, scores)
+        else:
+            green_tokens_mask = self._get_greenlist_mask_batched(input_ids, scores)
 
-            # logic for computing and storing spike entropies for analysis
-            if self.store_spike_ents:
-                if self.spike_entropies is None:
-                    self.spike_entropies = [[] for _ in range(input_ids.shape[0])]
-                self.spike_entropies[b_idx].append(self._compute_spike_entropy(scores[b_idx]))
+        # logic for computing and storing spike entropies for analysis
+        if self.store_spike_ents:
+            self._store_spike_entropies(scores)
 
-        green_tokens_mask = self._calc_greenlist_mask(scores=scores, greenlist_token_ids=list_of_greenlist_ids)
         scores = self._bias_greenlist_logits(scores=scores, greenlist_mask=green_tokens_mask, greenlist_bias=self.delta)
 
         return scores
@@ -215,6 +375,9 @@ class WatermarkDetector(WatermarkBase):
     * normalizers ["unicode", "homoglyphs", "truecase"] -> These can mitigate modifications to generated text that could trip the watermark
     * ignore_repeated_ngrams -> This option changes the detection rules to count every unique ngram only once.
     * z_threshold -> Changing this threshold will change the sensitivity of the detector.
+    * ngram_cache -> NgramGreennessCache to use, by default one in-memory cache is shared by all detectors.
+    * window_block_elements -> Memory cap of the vectorized window scoring (window_size="max").
+    * use_numpy_ngrams -> Count ngrams with numpy arrays instead of python tuples (same results, faster on long texts).
     """
 
     def __init__(
@@ -225,6 +388,9 @@ class WatermarkDetector(WatermarkBase):
         z_threshold: float = 4.0,
         normalizers: list[str] = ["unicode"],  # or also: ["unicode", "homoglyphs", "truecase"]
         ignore_repeated_ngrams: bool = True,
+        ngram_cache: NgramGreennessCache = None,
+        window_block_elements: int = 2**24,
+        use_numpy_ngrams: bool = True,
         **kwargs,
     ):
         super().__init__(*args, **kwargs)
@@ -241,6 +407,10 @@ class WatermarkDetector(WatermarkBase):
         for normalization_strategy in normalizers:
             self.normalizers.append(normalization_strategy_lookup(normalization_strategy))
         self.ignore_repeated_ngrams = ignore_repeated_ngrams
+        self.ngram_cache = ngram_cache if ngram_cache is not None else default_ngram_cache
+        # memory cap (number of float entries per block) of the vectorized window scoring
+        self.window_block_elements = window_block_elements
+        self.use_numpy_ngrams = use_numpy_ngrams
 
     def dummy_detect(
         self,
@@ -301,12 +471,21 @@ class WatermarkDetector(WatermarkBase):
         p_value = scipy.stats.norm.sf(z)
         return p_value
 
-    @lru_cache(maxsize=2**32)
-    def _get_ngram_score_cached(self, prefix: tuple[int], target: int):
-        """Expensive re-seeding and sampling is cached."""
-        # Handle with care, should ideally reset on __getattribute__ access to self.prf_type, self.context_width, self.self_salt, self.hash_key
-        greenlist_ids = self._get_greenlist_ids(torch.as_tensor(prefix, device=self.device))
-        return True if target in greenlist_ids else False
+    def _get_ngram_cache_key(self, prefix: tuple[int], target: int) -> tuple:
+        # all settings are part of the key, so changing them on the fly or sharing the cache is safe
+        return (
+            self.prf_type,
+            self.context_width,
+            self.self_salt,
+            self.hash_key,
+            self.gamma,
+            self.vocab_size,
+            self.select_green_tokens,
+            self.greenlist_type,
+            torch.device(self.device).type,  # device may be given as a string
+            prefix,
+            target,
+        )
 
     def _score_ngrams_in_passage(self, input_ids: torch.Tensor):
         """Core function to gather all ngrams in the input and compute their watermark."""
@@ -319,13 +498,87 @@ class WatermarkDetector(WatermarkBase):
         # Compute scores for all ngrams contexts in the passage:
         token_ngram_generator = ngrams(input_ids.cpu().tolist(), self.context_width + 1 - self.self_salt)
         frequencies_table = collections.Counter(token_ngram_generator)
-        ngram_to_watermark_lookup = {}
-        for idx, ngram_example in enumerate(frequencies_table.keys()):
-            prefix = ngram_example if self.self_salt else ngram_example[:-1]
-            target = ngram_example[-1]
-            ngram_to_watermark_lookup[ngram_example] = self._get_ngram_score_cached(prefix, target)
+        ngram_examples = list(frequencies_table.keys())
+        is_green = self._score_ngram_array(np.asarray(ngram_examples, dtype=np.int64)).tolist()
+        return dict(zip(ngram_examples, is_green)), frequencies_table
+
+    def _score_ngram_array(self, ngram_array: np.ndarray) -> np.ndarray:
+        """Watermark of every ngram (row) of a [num_ngrams, ngram_len] array, as a boolean array."""
+        if self.greenlist_table is not None:
+            # Lookup of every (previous token, target) bigram in the precomputed table
+            self.greenlist_table.validate(self, device=self.device)
+            prev_token_ids = torch.from_numpy(ngram_array[:, 0])
+            targets = torch.from_numpy(ngram_array[:, -1])
+            return self.greenlist_table.is_green(prev_token_ids, targets).numpy()
+
+        if self.greenlist_type == "hash":
+            # Membership of every ngram is tested at once, no greenlist is materialized
+            ngram_tensor = torch.as_tensor(ngram_array, device=self.device)
+            seeds = self._get_prf_keys_tensor(ngram_tensor if self.self_salt else ngram_tensor[:, :-1])
+            return self._is_green(seeds, ngram_tensor[:, -1]).cpu().numpy()
+
+        # Cache lookups first, then the PRF keys of all misses in one batched call
+        is_green = np.zeros(len(ngram_array), dtype=bool)
+        missing = []
+        for idx, ngram_example in enumerate(ngram_array.tolist()):
+            prefix = tuple(ngram_example if self.self_salt else ngram_example[:-1])
+            key = self._get_ngram_cache_key(prefix, ngram_example[-1])
+            cached = self.ngram_cache.get(key)
+            if cached is None:
+                missing.append((idx, key, ngram_example[-1]))
+            else:
+                is_green[idx] = cached
+        if len(missing) == 0:
+            return is_green
+
+        missing_ngrams = torch.as_tensor(ngram_array[[idx for idx, _, _ in missing]], device=self.device)
+        prf_keys = self._get_prf_keys(missing_ngrams if self.self_salt else missing_ngrams[:, :-1])
+        for (idx, key, target), prf_key in zip(missing, prf_keys):
+            greenlist_ids = self._get_greenlist_ids_from_key(prf_key, device=self.device)
+            is_green[idx] = True if target in greenlist_ids else False
+            self.ngram_cache.put(key, bool(is_green[idx]))
+        return is_green
+
+    def _get_green_at_T_booleans_array(self, input_ids: torch.Tensor) -> tuple:
+        """Array version of _score_ngrams_in_passage followed by _get_green_at_T_booleans, without per-token python loops.
+        The ngrams are the rows of a sliding window view of the input and are deduplicated with np.unique. Returns the
+        same green_token_mask, green_token_mask_unique and offsets, and the number of scored tokens."""
+        if len(input_ids) - self.context_width < 1:
+            raise ValueError(
+                f"Must have at least {1} token to score after "
+                f"the first min_prefix_len={self.context_width} tokens required by the seeding scheme."
+            )
+
+        unique_ngrams, first_index, inverse = self._get_unique_ngrams(input_ids, self.context_width + 1 - self.self_salt)
+        # every unique ngram is scored once, then broadcast back to all of its positions
+        return self._green_at_T_from_unique(self._score_ngram_array(unique_ngrams), first_index, inverse)
 
-        return ngram_to_watermark_lookup, frequencies_table
+    @staticmethod
+    def _get_unique_ngrams(input_ids: torch.Tensor, ngram_len: int) -> tuple[np.ndarray]:
+        """Unique ngrams of the input, the position of their first occurrence and the unique index of every position."""
+        token_ids = input_ids.cpu().numpy().astype(np.int64)
+        ngram_windows = sliding_window_view(token_ids, ngram_len)
+        unique_ngrams, first_index, inverse = np.unique(ngram_windows, axis=0, return_index=True, return_inverse=True)
+        return unique_ngrams, first_index, inverse.reshape(-1)
+
+    def _green_at_T_from_unique(self, green_of_unique: np.ndarray, first_index: np.ndarray, inverse: np.ndarray) -> tuple:
+        green_token_mask = green_of_unique[inverse]
+        if self.ignore_repeated_ngrams:
+            is_first = np.zeros(len(inverse), dtype=bool)
+            is_first[first_index] = True
+            green_token_mask_unique = green_token_mask[is_first]
+            offsets = np.cumsum(is_first) - 1
+            num_tokens_scored = len(first_index)
+        else:
+            green_token_mask_unique = green_token_mask
+            offsets = np.arange(len(inverse))
+            num_tokens_scored = len(inverse)
+        return (
+            torch.from_numpy(green_token_mask),
+            torch.from_numpy(green_token_mask_unique),
+            torch.from_numpy(offsets),
+            num_tokens_scored,
+        )
 
     def _get_green_at_T_booleans(self, input_ids, ngram_to_watermark_lookup) -> tuple[torch.Tensor]:
         """Generate binary list of green vs. red per token, a separate list that ignores repeated ngrams, and a list of offsets to
@@ -367,23 +620,27 @@ class WatermarkDetector(WatermarkBase):
         return_z_at_T: bool = True,
         return_p_value: bool = True,
     ):
-        ngram_to_watermark_lookup, frequencies_table = self._score_ngrams_in_passage(input_ids)
-        green_token_mask, green_unique, offsets = self._get_green_at_T_booleans(input_ids, ngram_to_watermark_lookup)
-
-        # Count up scores over all ngrams
-        if self.ignore_repeated_ngrams:
-            # Method that only counts a green/red hit once per unique ngram.
-            # New num total tokens scored (T) becomes the number unique ngrams.
-            # We iterate over all unqiue token ngrams in the input, computing the greenlist
-            # induced by the context in each, and then checking whether the last
-            # token falls in that greenlist.
-            num_tokens_scored = len(frequencies_table.keys())
-            green_token_count = sum(ngram_to_watermark_lookup.values())
+        if self.use_numpy_ngrams:
+            green_token_mask, green_unique, offsets, num_tokens_scored = self._get_green_at_T_booleans_array(input_ids)
+            green_token_count = int(green_unique.sum())
         else:
-            num_tokens_scored = sum(frequencies_table.values())
-            assert num_tokens_scored == len(input_ids) - self.context_width + self.self_salt
-            green_token_count = sum(freq * outcome for freq, outcome in zip(frequencies_table.values(), ngram_to_watermark_lookup.values()))
-        assert green_token_count == green_unique.sum()
+            ngram_to_watermark_lookup, frequencies_table = self._score_ngrams_in_passage(input_ids)
+            green_token_mask, green_unique, offsets = self._get_green_at_T_booleans(input_ids, ngram_to_watermark_lookup)
+
+            # Count up scores over all ngrams
+            if self.ignore_repeated_ngrams:
+                # Method that only counts a green/red hit once per unique ngram.
+                # New num total tokens scored (T) becomes the number unique ngrams.
+                # We iterate over all unqiue token ngrams in the input, computing the greenlist
+                # induced by the context in each, and then checking whether the last
+                # token falls in that greenlist.
+                num_tokens_scored = len(frequencies_table.keys())
+                green_token_count = sum(ngram_to_watermark_lookup.values())
+            else:
+                num_tokens_scored = sum(frequencies_table.values())
+                assert num_tokens_scored == len(input_ids) - self.context_width + self.self_salt
+                green_token_count = sum(freq * outcome for freq, outcome in zip(frequencies_table.values(), ngram_to_watermark_lookup.values()))
+            assert green_token_count == green_unique.sum()
 
         # HF-style output dictionary
         score_dict = dict()
@@ -415,6 +672,49 @@ class WatermarkDetector(WatermarkBase):
 
         return score_dict
 
+    def _score_windows_vectorized(self, partial_sum_id_table: torch.Tensor, sizes: list[int]):
+        """Window z-scores for all sizes and positions at once (window_stride=1), same results as the loop over sizes in
+        _score_windows_impl_batched. Sizes are processed in blocks of [block_sizes, len_full_context] matrices, with at most
+        window_block_elements entries per block."""
+        len_full_context = len(partial_sum_id_table)
+        z_score_max_per_window = torch.zeros(len(sizes))
+        cumulative_eff_z_score = torch.zeros(len_full_context)
+
+        fitting = [idx for idx, size in enumerate(sizes) if size <= len_full_context]
+        if len(fitting) == 0:
+            return z_score_max_per_window, cumulative_eff_z_score, False
+
+        padded_sums = torch.cat([torch.zeros(1, dtype=partial_sum_id_table.dtype), partial_sum_id_table])
+        positions = torch.arange(len_full_context)
+        block_size = max(1, self.window_block_elements // len_full_context)
+
+        for start in range(0, len(fitting), block_size):
+            block_idx = torch.as_tensor(fitting[start : start + block_size])
+            block_sizes = torch.as_tensor(sizes, dtype=torch.long)[block_idx]
+
+            # hits of the window of size s starting at j, for all j <= len_full_context - s
+            valid = positions[None, :] <= (len_full_context - block_sizes[:, None])
+            end = torch.clamp(positions[None, :] + block_sizes[:, None], max=len_full_context)
+            window_score = padded_sums[end] - padded_sums[positions][None, :]
+
+            # same float32 arithmetic as the per-size loop: (hits - gamma * size) / sqrt(size * gamma * (1 - gamma))
+            sizes_float = block_sizes.to(torch.float64)
+            expected = (self.gamma * sizes_float).to(torch.float32)
+            z_score_denom = torch.sqrt(sizes_float * self.gamma * (1 - self.gamma)).to(torch.float32)
+            batched_z_score = (window_score.to(torch.float32) - expected[:, None]) / z_score_denom[:, None]
+            batched_z_score = batched_z_score.masked_fill(~valid, float("-inf"))
+
+            z_score_max_per_window[block_idx] = batched_z_score.max(dim=1)[0]
+
+            # the running max of the windows starting at j is the effective score at T = j + s
+            z_score_at_effective_T = torch.cummax(batched_z_score, dim=1)[0]
+            shift = positions[None, :] - block_sizes[:, None]
+            shifted = torch.gather(z_score_at_effective_T, 1, torch.clamp(shift, min=0))
+            shifted = shifted.masked_fill(shift < 0, float("-inf"))
+            cumulative_eff_z_score = torch.maximum(cumulative_eff_z_score, shifted.max(dim=0)[0])
+
+        return z_score_max_per_window, cumulative_eff_z_score, True
+
     def _score_windows_impl_batched(
         self,
         input_ids: torch.Tensor,
@@ -429,8 +729,11 @@ class WatermarkDetector(WatermarkBase):
         #    ROC chart that calibrates to a chosen FPR. Due, to windowing, the multiple hypotheses will increase scores across the board#
         #    naive_count_correction=True is a partial remedy to this
 
-        ngram_to_watermark_lookup, frequencies_table = self._score_ngrams_in_passage(input_ids)
-        green_mask, green_ids, offsets = self._get_green_at_T_booleans(input_ids, ngram_to_watermark_lookup)
+        if self.use_numpy_ngrams:
+            green_mask, green_ids, offsets, _ = self._get_green_at_T_booleans_array(input_ids)
+        else:
+            ngram_to_watermark_lookup, frequencies_table = self._score_ngrams_in_passage(input_ids)
+            green_mask, green_ids, offsets = self._get_green_at_T_booleans(input_ids, ngram_to_watermark_lookup)
         len_full_context = len(green_ids)
 
         partial_sum_id_table = torch.cumsum(green_ids, dim=0)
@@ -442,32 +745,35 @@ class WatermarkDetector(WatermarkBase):
         else:
             sizes = [int(x) for x in window_size.split(",") if len(x) > 0]
 
-        z_score_max_per_window = torch.zeros(len(sizes))
-        cumulative_eff_z_score = torch.zeros(len_full_context)
-        s = window_stride
-
-        window_fits = False
-        for idx, size in enumerate(sizes):
-            if size <= len_full_context:
-                # Compute hits within window for all positions in parallel:
-                window_score = torch.zeros(len_full_context - size + 1, dtype=torch.long)
-                # Include 0-th window
-                window_score[0] = partial_sum_id_table[size - 1]
-                # All other windows from the 1st:
-                window_score[1:] = partial_sum_id_table[size::s] - partial_sum_id_table[:-size:s]
-
-                # Now compute batched z_scores
-                batched_z_score_enum = window_score - self.gamma * size
-                z_score_denom = sqrt(size * self.gamma * (1 - self.gamma))
-                batched_z_score = batched_z_score_enum / z_score_denom
-
-                # And find the maximal hit
-                maximal_z_score = batched_z_score.max()
-                z_score_max_per_window[idx] = maximal_z_score
-
-                z_score_at_effective_T = torch.cummax(batched_z_score, dim=0)[0]
-                cumulative_eff_z_score[size::s] = torch.maximum(cumulative_eff_z_score[size::s], z_score_at_effective_T[:-1])
-                window_fits = True  # successful computation for any window in sizes
+        if window_stride in (None, 1):
+            z_score_max_per_window, cumulative_eff_z_score, window_fits = self._score_windows_vectorized(partial_sum_id_table, sizes)
+        else:
+            z_score_max_per_window = torch.zeros(len(sizes))
+            cumulative_eff_z_score = torch.zeros(len_full_context)
+            s = window_stride
+
+            window_fits = False
+            for idx, size in enumerate(sizes):
+                if size <= len_full_context:
+                    # Compute hits within window for all positions in parallel:
+                    window_score = torch.zeros(len_full_context - size + 1, dtype=torch.long)
+                    # Include 0-th window
+                    window_score[0] = partial_sum_id_table[size - 1]
+                    # All other windows from the 1st:
+                    window_score[1:] = partial_sum_id_table[size::s] - partial_sum_id_table[:-size:s]
+
+                    # Now compute batched z_scores
+                    batched_z_score_enum = window_score - self.gamma * size
+                    z_score_denom = sqrt(size * self.gamma * (1 - self.gamma))
+                    batched_z_score = batched_z_score_enum / z_score_denom
+
+                    # And find the maximal hit
+                    maximal_z_score = batched_z_score.max()
+                    z_score_max_per_window[idx] = maximal_z_score
+
+                    z_score_at_effective_T = torch.cummax(batched_z_score, dim=0)[0]
+                    cumulative_eff_z_score[size::s] = torch.maximum(cumulative_eff_z_score[size::s], z_score_at_effective_T[:-1])
+                    window_fits = True  # successful computation for any window in sizes
 
         if not window_fits:
             raise ValueError(
@@ -534,24 +840,8 @@ class WatermarkDetector(WatermarkBase):
 
         return score_dict
 
-    def detect(
-        self,
-        text: str = None,
-        tokenized_text: list[int] = None,
-        window_size: str = None,
-        window_stride: int = None,
-        return_prediction: bool = True,
-        return_scores: bool = True,
-        z_threshold: float = None,
-        convert_to_float: bool = False,
-        **kwargs,
-    ) -> dict:
-        """Scores a given string of text and returns a dictionary of results."""
-
-        assert (text is not None) ^ (tokenized_text is not None), "Must pass either the raw or tokenized string"
-        if return_prediction:
-            kwargs["return_p_value"] = True  # to return the "confidence":=1-p of positive detections
-
+    def _tokenize_for_detection(self, text: str = None, tokenized_text: list[int] = None):
+        """Normalized and tokenized text without the bos token."""
         # run optional normalizers on text
         for normalizer in self.normalizers:
             text = normalizer(text)
@@ -571,6 +861,27 @@ class WatermarkDetector(WatermarkBase):
             # try to remove the bos_tok at beginning if it's there
             if (self.tokenizer is not None) and (tokenized_text[0] == self.tokenizer.bos_token_id):
                 tokenized_text = tokenized_text[1:]
+        return tokenized_text
+
+    def detect(
+        self,
+        text: str = None,
+        tokenized_text: list[int] = None,
+        window_size: str = None,
+        window_stride: int = None,
+        return_prediction: bool = True,
+        return_scores: bool = True,
+        z_threshold: float = None,
+        convert_to_float: bool = False,
+        **kwargs,
+    ) -> dict:
+        """Scores a given string of text and returns a dictionary of results."""
+
+        assert (text is not None) ^ (tokenized_text is not None), "Must pass either the raw or tokenized string"
+        if return_prediction:
+            kwargs["return_p_value"] = True  # to return the "confidence":=1-p of positive detections
+
+        tokenized_text = self._tokenize_for_detection(text, tokenized_text)
 
         # call score method
         output_dict = {}
@@ -604,6 +915,209 @@ class WatermarkDetector(WatermarkBase):
 
         return output_dict
 
+    def _with_seeding_scheme(self, seeding_scheme: str = None, hash_key: int = None) -> "WatermarkDetector":
+        """Shallow copy of this detector with another seeding scheme and/or hash key. Tokenizer, normalizers and the
+        ngram cache are shared (cache keys contain all settings), the copy gets its own greenlist cache."""
+        detector = copy.copy(self)
+        detector.greenlist_cache = GreenlistCache(max_bytes=self.greenlist_cache.max_bytes)
+        if seeding_scheme is not None:
+            detector._initialize_seeding_scheme(seeding_scheme)
+        if hash_key is not None:
+            detector.hash_key = hash_key
+        if self.greenlist_table is not None:
+            try:
+                self.greenlist_table.validate(detector)
+            except ValueError:
+                detector.greenlist_table = None
+        return detector
+
+    def detect_multi_key(
+        self,
+        text: str = None,
+        tokenized_text: list[int] = None,
+        seeding_schemes: list[str] = None,
+        hash_keys: list[int] = None,
+        z_threshold: float = None,
+    ) -> list[dict]:
+        """Scores a text against several candidate watermark keys, e.g. to attribute it to one of many rotated keys.
+        Candidates are all combinations of seeding_schemes (default: the scheme of this detector) and hash_keys
+        (default: the hash key of each scheme). The text is tokenized once and its ngrams are built and deduplicated
+        once per ngram length, then the greenness of all unique ngrams is evaluated key by key with the batched PRFs.
+        Returns one row of scores per candidate, in order."""
+        assert (text is not None) ^ (tokenized_text is not None), "Must pass either the raw or tokenized string"
+        z_threshold = z_threshold if z_threshold else self.z_threshold
+        tokenized_text = self._tokenize_for_detection(text, tokenized_text)
+
+        candidates = []
+        for seeding_scheme in seeding_schemes if seeding_schemes is not None else [None]:
+            for hash_key in hash_keys if hash_keys is not None else [None]:
+                candidates.append(self._with_seeding_scheme(seeding_scheme, hash_key))
+
+        unique_ngrams_by_len = {}
+        score_table = []
+        for detector in candidates:
+            ngram_len = detector.context_width + 1 - detector.self_salt
+            if len(tokenized_text) - detector.context_width < 1:
+                raise ValueError(
+                    f"Must have at least {1} token to score after "
+                    f"the first min_prefix_len={detector.context_width} tokens required by the seeding scheme."
+                )
+            if ngram_len not in unique_ngrams_by_len:
+                unique_ngrams_by_len[ngram_len] = self._get_unique_ngrams(tokenized_text, ngram_len)
+            unique_ngrams, first_index, inverse = unique_ngrams_by_len[ngram_len]
+
+            _, green_unique, _, num_tokens_scored = detector._green_at_T_from_unique(
+                detector._score_ngram_array(unique_ngrams), first_index, inverse
+            )
+            green_token_count = int(green_unique.sum())
+            z_score = detector._compute_z_score(green_token_count, num_tokens_scored)
+            score_table.append(
+                dict(
+                    seeding_scheme=detector.seeding_scheme,
+                    greenlist_type=detector.greenlist_type,
+                    prf_type=detector.prf_type,
+                    context_width=detector.context_width,
+                    self_salt=detector.self_salt,
+                    hash_key=detector.hash_key,
+                    num_tokens_scored=num_tokens_scored,
+                    num_green_tokens=green_token_count,
+                    green_fraction=green_token_count / num_tokens_scored,
+                    z_score=z_score,
+                    p_value=detector._compute_p_value(z_score),
+                    prediction=z_score > z_threshold,
+                )
+            )
+        return score_table
+
+    def detect_stream(
+        self,
+        token_id_chunks: Iterable,
+        segment_length: int = 4096,
+        window_sizes: list[int] = None,
+        max_unique_ngrams: int = 2**20,
+        z_threshold: float = None,
+    ) -> Iterator[dict]:
+        """Scores a long document incrementally. token_id_chunks is any iterable of token id chunks (lists or tensors,
+        of any length), e.g. the tokenized pieces of a large file. Tokens are scored in segments of segment_length and
+        one dictionary of results is yielded per segment, with the scores of the segment, the running scores of the
+        document so far, and (for the given window_sizes) the maximal window z-scores seen so far.
+
+        Memory stays bounded: besides the current segment only the last context tokens, the last max(window_sizes)
+        green/red outcomes and at most max_unique_ngrams ngrams (for ignore_repeated_ngrams, least recently seen
+        are forgotten first) are kept. With a large enough max_unique_ngrams the final running scores equal detect().
+        Normalizers are not applied, the chunks are expected to be token ids of the generating tokenizer."""
+        z_threshold = z_threshold if z_threshold else self.z_threshold
+        window_sizes = sorted(window_sizes) if window_sizes is not None else []
+        ngram_len = self.context_width + 1 - self.self_salt
+
+        seen_ngrams = collections.OrderedDict()
+        carry = np.zeros(0, dtype=np.int64)  # last ngram_len - 1 tokens of the previous segment
+        window_buffer = np.zeros(0, dtype=np.int64)  # last max(window_sizes) - 1 outcomes of the scored sequence
+        window_z_max = {size: float("-inf") for size in window_sizes}
+        total_scored, total_green, segment_idx = 0, 0, 0
+        pending, num_pending, is_first_token = [], 0, True
+
+        def score_segment(segment_ids):
+            nonlocal carry, window_buffer, total_scored, total_green, segment_idx
+            token_ids = np.concatenate([carry, segment_ids])
+            carry = token_ids[len(token_ids) - (ngram_len - 1) :] if ngram_len > 1 else token_ids[:0]
+            if len(token_ids) < ngram_len:
+                return None
+
+            ngram_windows = sliding_window_view(token_ids, ngram_len)
+            unique_ngrams, first_index, inverse = np.unique(ngram_windows, axis=0, return_index=True, return_inverse=True)
+            inverse = inverse.reshape(-1)
+            if self.ignore_repeated_ngrams:
+                # only ngrams not seen in earlier segments are scored, each once at its first position
+                is_new = np.zeros(len(unique_ngrams), dtype=bool)
+                for idx, ngram_example in enumerate(map(tuple, unique_ngrams.tolist())):
+                    if ngram_example in seen_ngrams:
+                        seen_ngrams.move_to_end(ngram_example)
+                    else:
+                        is_new[idx] = True
+                        seen_ngrams[ngram_example] = True
+                while len(seen_ngrams) > max_unique_ngrams:
+                    seen_ngrams.popitem(last=False)
+                green_of_unique = np.zeros(len(unique_ngrams), dtype=bool)
+                if is_new.any():
+                    green_of_unique[is_new] = self._score_ngram_array(unique_ngrams[is_new])
+                new_first_index = np.sort(first_index[is_new])
+                green_sequence = green_of_unique[inverse[new_first_index]]
+            else:
+                green_sequence = self._score_ngram_array(unique_ngrams)[inverse]
+            green_sequence = green_sequence.astype(np.int64)
+
+            num_scored, num_green = len(green_sequence), int(green_sequence.sum())
+            total_scored += num_scored
+            total_green += num_green
+
+            # window maxima over the windows that end in this segment
+            if len(window_sizes) > 0:
+                buffered = np.concatenate([window_buffer, green_sequence])
+                partial_sums = np.concatenate([[0], np.cumsum(buffered)])
+                for size in window_sizes:
+                    first_end = max(size, len(window_buffer) + 1)
+                    if first_end > len(buffered):
+                        continue
+                    window_score = partial_sums[first_end:] - partial_sums[first_end - size : len(buffered) - size + 1]
+                    z_score = (window_score.max() - self.gamma * size) / sqrt(size * self.gamma * (1 - self.gamma))
+                    window_z_max[size] = max(window_z_max[size], float(z_score))
+                window_buffer = buffered[max(0, len(buffered) - (window_sizes[-1] - 1)) :]
+
+            segment_z_score = self._compute_z_score(num_green, num_scored) if num_scored > 0 else float("nan")
+            total_z_score = self._compute_z_score(total_green, total_scored) if total_scored > 0 else float("nan")
+            output_dict = dict(
+                segment_idx=segment_idx,
+                num_tokens_scored=num_scored,
+                num_green_tokens=num_green,
+                z_score=segment_z_score,
+                total_num_tokens_scored=total_scored,
+                total_num_green_tokens=total_green,
+                total_z_score=total_z_score,
+                total_p_value=self._compute_p_value(total_z_score),
+                prediction=total_z_score > z_threshold,
+            )
+            if len(window_sizes) > 0:
+                output_dict["window_z_score_max"] = dict(window_z_max)
+            segment_idx += 1
+            return output_dict
+
+        for chunk in token_id_chunks:
+            chunk = np.asarray(chunk.cpu() if torch.is_tensor(chunk) else chunk, dtype=np.int64).reshape(-1)
+            if is_first_token and len(chunk) > 0:
+                # try to remove the bos_tok at beginning if it's there
+                if (self.tokenizer is not None) and (chunk[0] == self.tokenizer.bos_token_id):
+                    chunk = chunk[1:]
+                is_first_token = False
+            pending.append(chunk)
+            num_pending += len(chunk)
+            while num_pending >= segment_length:
+                buffered = np.concatenate(pending)
+                pending, num_pending = [buffered[segment_length:]], len(buffered) - segment_length
+                output_dict = score_segment(buffered[:segment_length])
+                if output_dict is not None:
+                    yield output_dict
+        if num_pending > 0:
+            output_dict = score_segment(np.concatenate(pending))
+            if output_dict is not None:
+                yield output_dict
+
+    def detect_batch(self, texts: list[str], batch_size: int = None, **kwargs) -> list[dict]:
+        """Scores a list of texts, returns one dictionary of results per text in input order.
+        KGW needs no model forward, so there is nothing to batch across texts beyond the shared ngram cache;
+        batch_size is accepted for interface parity with the other detectors. Texts that are too short to score
+        get the nan results of dummy_detect instead of raising."""
+        results = []
+        for text in texts:
+            try:
+                results.append(self.detect(text, **kwargs))
+            except ValueError as e:
+                if "Must have at least" in str(e):
+                    results.append(self.dummy_detect())
+                else:
+                    raise e
+        return results
+
 
 ##########################################################################
 # Ngram iteration from nltk, extracted to remove the dependency
@@ -0,0 +1,66 @@
+"""Byte-bounded LRU cache of permutation greenlists for WatermarkBase.
+
+A greenlist is keyed by everything its draw depends on: (seed, vocab_size, gamma, select_green_tokens, device), so a
+cache can never hand out a greenlist drawn under other settings. Entries are kept on their device, the budget counts
+the bytes of the cached tensors.
+"""
+
+import collections
+
+import torch
+
+
+class GreenlistCache:
+    def __init__(self, max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    @staticmethod
+    def _entry_bytes(greenlist_ids: torch.LongTensor) -> int:
+        return greenlist_ids.numel() * greenlist_ids.element_size()
+
+    def get(self, key: tuple):
+        """Cached greenlist of key, or None."""
+        if key in self._data:
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key]
+        self.misses += 1
+        return None
+
+    def put(self, key: tuple, greenlist_ids: torch.LongTensor):
+        """Cache greenlist_ids, which must own its storage (a slice would keep its base tensor alive)."""
+        entry_bytes = self._entry_bytes(greenlist_ids)
+        if entry_bytes > self.max_bytes:
+            return
+        if key in self._data:
+            self.used_bytes -= self._entry_bytes(self._data[key])
+        self._data[key] = greenlist_ids
+        self._data.move_to_end(key)
+        self.used_bytes += entry_bytes
+        while self.used_bytes > self.max_bytes:
+            _, evicted = self._data.popitem(last=False)
+            self.used_bytes -= self._entry_bytes(evicted)
+
+    def clear(self):
+        self._data.clear()
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total > 0 else 0.0,
+            "size": len(self._data),
+            "used_bytes": self.used_bytes,
+            "max_bytes": self.max_bytes,
+        }
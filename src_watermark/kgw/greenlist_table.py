@@ -0,0 +1,123 @@
+"""Precomputed greenlists for seeding schemes with context_width=1 (e.g. simple_1/lefthash).
+
+With a context width of 1 and no self salt, the greenlist only depends on the previous token id, so there are exactly
+vocab_size possible greenlists. They are stored as a bit-packed [vocab_size, vocab_size] matrix on disk (~128 MB for
+a 32k vocabulary) next to a small json header with the watermark settings. The matrix is memory-mapped at load time,
+so generation and detection look up masks and memberships without any RNG work.
+
+Build a table with (the device must match the rng device used at generation and detection time):
+    python -m src_watermark.kgw.greenlist_table --model meta-llama/Llama-2-7b-hf --gamma 0.25 \
+        --seeding_scheme lefthash --output_file data/greenlist/lefthash_llama2-7b.bin
+"""
+
+import os
+import json
+import argparse
+
+import numpy as np
+import torch
+
+
+class GreenlistTable:
+    def __init__(self, path: str):
+        with open(path + ".json", "r") as f:
+            self.header = json.load(f)
+        self.vocab_size = self.header["vocab_size"]
+        self.device_type = self.header["device"]
+        self.bits = np.memmap(path, dtype=np.uint8, mode="r", shape=(self.vocab_size, (self.vocab_size + 7) // 8))
+
+    def validate(self, watermark_base, device: torch.device = None) -> None:
+        """Raise if the table was built for other watermark settings than the ones of watermark_base."""
+        expected = dict(
+            vocab_size=watermark_base.vocab_size,
+            gamma=watermark_base.gamma,
+            prf_type=watermark_base.prf_type,
+            context_width=watermark_base.context_width,
+            self_salt=watermark_base.self_salt,
+            hash_key=watermark_base.hash_key,
+            select_green_tokens=watermark_base.select_green_tokens,
+        )
+        for key, value in expected.items():
+            if self.header[key] != value:
+                raise ValueError(f"Greenlist table was built with {key}={self.header[key]}, but the watermark uses {key}={value}.")
+        if device is not None and torch.device(device).type != self.device_type:
+            raise ValueError(f"Greenlist table was built with {self.device_type} rng, but the watermark runs on {torch.device(device).type}.")
+
+    def get_mask(self, prev_token_ids: torch.LongTensor) -> torch.BoolTensor:
+        """Green masks [len(prev_token_ids), vocab_size] on the device of prev_token_ids."""
+        rows = self.bits[prev_token_ids.cpu().numpy()]
+        mask = np.unpackbits(rows, axis=1, count=self.vocab_size)
+        return torch.from_numpy(mask).to(prev_token_ids.device).bool()
+
+    def is_green(self, prev_token_ids: torch.LongTensor, target_ids: torch.LongTensor) -> torch.BoolTensor:
+        """Membership of target_ids[i] in the greenlist of prev_token_ids[i], without unpacking full rows."""
+        prev_token_ids = prev_token_ids.cpu().numpy()
+        target_ids = target_ids.cpu().numpy()
+        packed = self.bits[prev_token_ids, target_ids >> 3]
+        green = (packed >> (7 - (target_ids & 7))) & 1
+        return torch.from_numpy(green.astype(bool))
+
+
+def build_greenlist_table(
+    output_file: str,
+    vocab_size: int,
+    gamma: float,
+    seeding_scheme: str,
+    select_green_tokens: bool = True,
+    device: torch.device = torch.device("cpu"),
+    rows_per_block: int = 1024,
+) -> GreenlistTable:
+    # imported here to avoid a circular import, extended_watermark_processor loads tables through this module
+    from .extended_watermark_processor import WatermarkBase
+
+    device = torch.device(device)
+    watermark_base = WatermarkBase(vocab=list(range(vocab_size)), gamma=gamma, seeding_scheme=seeding_scheme, select_green_tokens=select_green_tokens)
+    if watermark_base.context_width != 1 or watermark_base.self_salt or watermark_base.greenlist_type != "permutation":
+        raise ValueError(f"Seeding scheme {seeding_scheme} does not have one greenlist per previous token.")
+    watermark_base.rng = torch.Generator(device=device)
+
+    if os.path.dirname(output_file) != "":
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    bits = np.memmap(output_file, dtype=np.uint8, mode="w+", shape=(vocab_size, (vocab_size + 7) // 8))
+    for start in range(0, vocab_size, rows_per_block):
+        stop = min(start + rows_per_block, vocab_size)
+        block = torch.zeros(stop - start, vocab_size, dtype=torch.bool)
+        for prev_token_id in range(start, stop):
+            prf_key = watermark_base._get_prf_key(torch.tensor([prev_token_id], device=device))
+            block[prev_token_id - start, watermark_base._get_greenlist_ids_from_key(prf_key, device=device).cpu()] = True
+        bits[start:stop] = np.packbits(block.numpy(), axis=1)
+    bits.flush()
+    del bits
+
+    header = dict(
+        vocab_size=vocab_size,
+        gamma=gamma,
+        prf_type=watermark_base.prf_type,
+        context_width=watermark_base.context_width,
+        self_salt=watermark_base.self_salt,
+        hash_key=watermark_base.hash_key,
+        select_green_tokens=select_green_tokens,
+        device=device.type,
+    )
+    with open(output_file + ".json", "w") as f:
+        json.dump(header, f, indent=4)
+    return GreenlistTable(output_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute the greenlists of a context_width=1 seeding scheme.")
+    parser.add_argument("--model", type=str, required=True, help="Model name, only the tokenizer is used")
+    parser.add_argument("--output_file", type=str, required=True, help="Output file path")
+    parser.add_argument("--gamma", type=float, default=0.25)
+    parser.add_argument("--seeding_scheme", type=str, default="lefthash")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu", help="Must match the rng device used for generation/detection")
+    args = parser.parse_args()
+
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model, trust_remote_code=True)
+    build_greenlist_table(args.output_file, len(tokenizer.get_vocab()), args.gamma, args.seeding_scheme, device=args.device)
+
+
+if __name__ == "__main__":
+    main()
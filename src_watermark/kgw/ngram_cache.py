@@ -0,0 +1,103 @@
+"""Bounded cache of ngram greenness for WatermarkDetector, shareable between detectors and, through an optional
+sqlite file, between worker processes and runs.
+
+An entry is keyed by everything its greenness depends on:
+(prf_type, context_width, self_salt, hash_key, gamma, vocab_size, select_green_tokens, greenlist_type, device type,
+prefix, target), so detectors with different settings can safely share one cache. The rng device type is part of the
+key because cpu and cuda generators draw different permutations from the same seed.
+"""
+
+import sqlite3
+import collections
+
+
+class NgramGreennessCache:
+    def __init__(self, max_entries: int = 2**18, path: str = None, commit_every: int = 10_000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+
+        # optional on-disk backing store
+        self.path = path
+        self.commit_every = commit_every
+        self._db = None
+        self._pending_writes = []
+        if path is not None:
+            self._db = sqlite3.connect(path, timeout=60)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS ngram_greenness (key TEXT PRIMARY KEY, green INTEGER NOT NULL)")
+            self._db.commit()
+
+    def __len__(self):
+        return len(self._data)
+
+    @staticmethod
+    def _serialize(key: tuple) -> str:
+        return repr(key)
+
+    def _put_in_memory(self, key: tuple, value: bool):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def get(self, key: tuple):
+        """Greenness of key, or None if it is neither in memory nor on disk."""
+        if key in self._data:
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key]
+        if self._db is not None:
+            row = self._db.execute("SELECT green FROM ngram_greenness WHERE key = ?", (self._serialize(key),)).fetchone()
+            if row is not None:
+                self.disk_hits += 1
+                value = bool(row[0])
+                self._put_in_memory(key, value)
+                return value
+        self.misses += 1
+        return None
+
+    def put(self, key: tuple, value: bool):
+        if self.max_entries > 0:
+            self._put_in_memory(key, value)
+        if self._db is not None:
+            self._pending_writes.append((self._serialize(key), int(value)))
+            if len(self._pending_writes) >= self.commit_every:
+                self.flush()
+
+    def flush(self):
+        """Write buffered entries to the backing store."""
+        if self._db is not None and len(self._pending_writes) > 0:
+            self._db.executemany("INSERT OR IGNORE INTO ngram_greenness (key, green) VALUES (?, ?)", self._pending_writes)
+            self._db.commit()
+            self._pending_writes = []
+
+    def close(self):
+        self.flush()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def clear(self):
+        """Clear the in-memory entries and the statistics, the backing store is kept."""
+        self._data.clear()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def stats(self):
+        total = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / total if total > 0 else 0.0,
+            "size": len(self._data),
+            "max_entries": self.max_entries,
+        }
+
+
+# Shared by all detectors that are not given their own cache
+default_ngram_cache = NgramGreennessCache()
@@ -0,0 +1,28 @@
+from typing import Callable
+
+
+class BatchScheduler:
+    """Packs work items coming from many documents into fixed-size batches.
+
+    Every document is expanded into a list of work items (e.g. context sentences for an embedder, or the texts
+    themselves for an LLM). Items of consecutive documents are packed into batches of batch_size items (only the
+    last batch can be smaller), run_batch is called once per batch, and its outputs are routed back to the
+    document and position they came from.
+    """
+
+    def __init__(self, batch_size: int, run_batch: Callable[[list], list]):
+        assert batch_size > 0, "batch_size must be positive"
+        self.batch_size = batch_size
+        self.run_batch = run_batch
+
+    def run(self, documents: list[list]) -> list[list]:
+        """documents[d] is the list of work items of document d, returns the outputs in the same layout."""
+        results = [[None for _ in items] for items in documents]
+        queue = [(d_idx, i_idx, item) for d_idx, items in enumerate(documents) for i_idx, item in enumerate(items)]
+
+        for start in range(0, len(queue), self.batch_size):
+            batch = queue[start : start + self.batch_size]
+            outputs = self.run_batch([item for _, _, item in batch])
+            for (d_idx, i_idx, _), output in zip(batch, outputs):
+                results[d_idx][i_idx] = output
+        return results
@@ -19,6 +19,12 @@ class AbstractWatermarkCode(ABC):
         """When rng is a list, it should have the same length as the batch size."""
         pass
 
+    @classmethod
+    def from_keys(cls, keys: LongTensor, vocab_size: int):
+        """Batched codes from the [batch_size] counter-based generator keys of the "philox-v1" code scheme,
+        see counterrng.py."""
+        raise NotImplementedError(f"{cls.__name__} does not support counter-based code derivation")
+
 
 class AbstractReweight(ABC):
     watermark_code_type: type[AbstractWatermarkCode]
@@ -47,3 +53,8 @@ class AbstractContextCodeExtractor(ABC):
     def extract(self, context: LongTensor) -> any:
         """Should return a context code `c` which will be used to initialize a torch.Generator."""
         pass
+
+    def extract_batch(self, input_ids: LongTensor) -> LongTensor:
+        """Contexts of all rows of a [batch_size, seq_len] batch as a [batch_size, context_len] tensor, kept on the
+        device of input_ids. Used by the "philox-v1" code scheme."""
+        raise NotImplementedError(f"{type(self).__name__} does not support batched context extraction")
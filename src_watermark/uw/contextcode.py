@@ -11,6 +11,9 @@ class All_ContextCodeExtractor(AbstractContextCodeExtractor):
     def extract(self, context: LongTensor) -> any:
         return context.detach().cpu().numpy().tobytes()
 
+    def extract_batch(self, input_ids: LongTensor) -> LongTensor:
+        return input_ids.detach()
+
 
 @dataclass
 class PrevN_ContextCodeExtractor(AbstractContextCodeExtractor):
@@ -20,3 +23,6 @@ class PrevN_ContextCodeExtractor(AbstractContextCodeExtractor):
 
     def extract(self, context: LongTensor) -> any:
         return context[-self.n :].detach().cpu().numpy().tobytes()
+
+    def extract_batch(self, input_ids: LongTensor) -> LongTensor:
+        return input_ids[:, -self.n :].detach()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Counter-based derivation of watermark codes for a whole batch on-device.
+
+The "sha256-v1" scheme of WatermarkLogitsProcessor hashes every context with sha256 on the host and draws the code
+of every row from its own torch.Generator. The "philox-v1" scheme instead hashes all contexts with a keyed integer
+hash on their device and derives the random numbers of every row from a Philox4x32-10 counter-based generator, keyed
+by the context hash: the i-th 32-bit output of a row only depends on (key, i), so all rows and all vocabulary entries
+are computed by the same tensor ops, without host syncs or per-row generators.
+
+All 32-bit arithmetic is carried out in int64 tensors holding uint32 values, so it runs on every torch device.
+"""
+
+import hashlib
+
+import torch
+from torch import FloatTensor, LongTensor
+
+from ..hashing import fmix32
+
+code_schemes = ("sha256-v1", "philox-v1")
+
+_MASK32 = 0xFFFFFFFF
+_PHILOX_M0 = 0xD2511F53
+_PHILOX_M1 = 0xCD9E8D57
+_PHILOX_W0 = 0x9E3779B9
+_PHILOX_W1 = 0xBB67AE85
+
+
+def _mulhilo32(a: int, b: LongTensor) -> tuple[LongTensor, LongTensor]:
+    """High and low 32 bits of the 64-bit product a * b of uint32 values, via 16-bit halves of b so no intermediate
+    exceeds 2^49."""
+    b_hi, b_lo = b >> 16, b & 0xFFFF
+    p_hi, p_lo = a * b_hi, a * b_lo
+    hi = (p_hi + (p_lo >> 16)) >> 16
+    lo = (((p_hi & 0xFFFF) << 16) + p_lo) & _MASK32
+    return hi, lo
+
+
+def private_key_to_int(private_key: bytes) -> int:
+    """64-bit integer derived once from the private key."""
+    return int.from_bytes(hashlib.sha256(private_key).digest()[:8], "big")
+
+
+def hash_contexts(contexts: LongTensor, private_key: int) -> LongTensor:
+    """Keyed hash of every row of a [batch_size, context_len] tensor of token ids to a 64-bit key (as int64), whose
+    low half mixes in the tokens in order and whose high half is taken from the private key."""
+    h = torch.full(contexts.shape[:1], private_key & _MASK32, dtype=torch.long, device=contexts.device)
+    for idx in range(contexts.shape[-1]):
+        h = fmix32(h ^ ((contexts[:, idx] * 0x9E3779B1) & _MASK32))
+        h = (h * 5 + 0xE6546B64) & _MASK32
+    h = fmix32(h ^ contexts.shape[-1])
+    key_hi = (private_key >> 32) & _MASK32
+    key_hi = key_hi - 2**32 if key_hi >= 2**31 else key_hi  # as signed int32, so the shift stays in int64
+    return (key_hi << 32) | h
+
+
+def philox_bits(keys: LongTensor, num_values: int, rounds: int = 10) -> LongTensor:
+    """[batch_size, num_values] uint32 outputs of Philox4x32 for counters 0..num_values/4 under each row's key."""
+    num_blocks = (num_values + 3) // 4
+    k0 = (keys & _MASK32)[:, None]
+    k1 = ((keys >> 32) & _MASK32)[:, None]
+    c0 = torch.arange(num_blocks, dtype=torch.long, device=keys.device)[None, :].expand(len(keys), -1)
+    c1 = torch.zeros_like(c0)
+    c2 = torch.zeros_like(c0)
+    c3 = torch.zeros_like(c0)
+    for _ in range(rounds):
+        hi0, lo0 = _mulhilo32(_PHILOX_M0, c0)
+        hi1, lo1 = _mulhilo32(_PHILOX_M1, c2)
+        c0, c1, c2, c3 = hi1 ^ c1 ^ k0, lo1, hi0 ^ c3 ^ k1, lo0
+        k0 = (k0 + _PHILOX_W0) & _MASK32
+        k1 = (k1 + _PHILOX_W1) & _MASK32
+    return torch.stack([c0, c1, c2, c3], dim=-1).reshape(len(keys), -1)[:, :num_values]
+
+
+def philox_uniforms(keys: LongTensor, num_values: int) -> FloatTensor:
+    """[batch_size, num_values] uniforms in the open interval (0, 1), with 24 bits of resolution."""
+    bits = philox_bits(keys, num_values)
+    return ((bits >> 8).to(torch.float32) + 0.5) / 2**24
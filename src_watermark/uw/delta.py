@@ -1,8 +1,9 @@
 import torch
-from torch import FloatTensor
+from torch import FloatTensor, LongTensor
 from torch.nn import functional as F
 
 from . import AbstractWatermarkCode, AbstractReweight, AbstractScore
+from .counterrng import philox_uniforms
 
 
 class Delta_WatermarkCode(AbstractWatermarkCode):
@@ -28,6 +29,11 @@ class Delta_WatermarkCode(AbstractWatermarkCode):
             u = torch.rand((), generator=rng, device=rng.device)
         return cls(u)
 
+    @classmethod
+    def from_keys(cls, keys: LongTensor, vocab_size: int):
+        u = philox_uniforms(keys, 1)[:, 0]
+        return cls(u)
+
 
 class Delta_Reweight(AbstractReweight):
     watermark_code_type = Delta_WatermarkCode
@@ -1,8 +1,9 @@
 import torch
-from torch import FloatTensor
+from torch import FloatTensor, LongTensor
 from torch.nn import functional as F
 
 from . import AbstractWatermarkCode, AbstractReweight, AbstractScore
+from .counterrng import philox_uniforms
 
 
 def get_gumbel_variables(rng, vocab_size):
@@ -31,6 +32,12 @@ class DeltaGumbel_WatermarkCode(AbstractWatermarkCode):
             g = get_gumbel_variables(rng, vocab_size)[2]
         return cls(g)
 
+    @classmethod
+    def from_keys(cls, keys: LongTensor, vocab_size: int):
+        u = philox_uniforms(keys, vocab_size)  # ~ Unif(0, 1), never exactly 0 or 1
+        g = -torch.log(-torch.log(u))  # ~ Gumbel(0, 1)
+        return cls(g)
+
 
 class DeltaGumbel_Reweight(AbstractReweight):
     watermark_code_type = DeltaGumbel_WatermarkCode
@@ -1,6 +1,6 @@
 import torch
 
-def get_wp(watermark_type, key):
+def get_wp(watermark_type, key, code_scheme="sha256-v1"):
     from . import (
         WatermarkLogitsProcessor,
         Delta_Reweight,
@@ -14,22 +14,40 @@ def get_wp(watermark_type, key):
         rw = Gamma_Reweight()
     else:
         raise ValueError(f"Unknown watermark type: {watermark_type}")
-    wp = WatermarkLogitsProcessor(key, rw, PrevN_ContextCodeExtractor(5))
+    wp = WatermarkLogitsProcessor(key, rw, PrevN_ContextCodeExtractor(5), code_scheme=code_scheme)
     return wp
 
 
-def r_llr_score(Model, Tokenizer, texts, dist_qs, watermark_type, key, **kwargs):
+def _is_position_independent(logits_processor, logits_warper):
+    """True if processors and warpers only look at the scores of a position (not at its prefix), so they can be
+    applied to the logits of all positions at once. Otherwise r_llr_score falls back to scoring prefix by prefix."""
+    from transformers import TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+
+    return len(logits_processor) == 0 and all(
+        type(warper) in (TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper) for warper in logits_warper
+    )
+
+
+def r_llr_score(Model, Tokenizer, texts, dist_qs, watermark_type, key, code_scheme="sha256-v1", memory_budget=None, **kwargs):
     from . import RobustLLR_Score_Batch_v2
 
-    score = RobustLLR_Score_Batch_v2.from_grid([0.0], dist_qs)
+    # memory_budget (bytes) bounds the working memory of the scoring, see RobustLLR_Score_Batch_v2
+    score = RobustLLR_Score_Batch_v2.from_grid([0.0], dist_qs, memory_budget=memory_budget)
 
-    wp = get_wp(watermark_type, key)
+    wp = get_wp(watermark_type, key, code_scheme)
     wp.ignore_history = True
 
     # cache = load_model(model_str)
 
     #inputs = cache["tokenizer"](texts, return_tensors="pt", padding=True)
-    inputs = Tokenizer(texts, return_tensors="pt", padding=True)
+    # pad on the right so that batching texts does not shift the positions of the real tokens, the caller's
+    # padding side is restored afterwards (transformers 4.38 has no per-call padding_side)
+    padding_side = Tokenizer.padding_side
+    Tokenizer.padding_side = "right"
+    try:
+        inputs = Tokenizer(texts, return_tensors="pt", padding=True)
+    finally:
+        Tokenizer.padding_side = padding_side
 
     from transformers import GenerationConfig
 
@@ -61,15 +79,22 @@ def r_llr_score(Model, Tokenizer, texts, dist_qs, watermark_type, key, **kwargs)
                     #temperature=0.7
                     )
     logits = outputs.logits
-    old_logits = torch.clone(logits)
-    new_logits = torch.clone(logits)
-    for i in range(logits.size(1)):
-        pre = input_ids[:, : i + 1]
-        t = logits[:, i]
-        t = logits_processor(pre, t)
-        t = logits_warper(pre, t)
-        old_logits[:, i] = t
-        new_logits[:, i] = wp(pre, t)
+    if _is_position_independent(logits_processor, logits_warper):
+        # all positions at once, same results as the loop below
+        batch_size, seq_len, vocab_size = logits.shape
+        flat_logits = logits.reshape(batch_size * seq_len, vocab_size)
+        old_logits = logits_warper(input_ids, flat_logits).reshape(batch_size, seq_len, vocab_size)
+        new_logits = wp.reweight_all_positions(input_ids, old_logits)
+    else:
+        old_logits = torch.clone(logits)
+        new_logits = torch.clone(logits)
+        for i in range(logits.size(1)):
+            pre = input_ids[:, : i + 1]
+            t = logits[:, i]
+            t = logits_processor(pre, t)
+            t = logits_warper(pre, t)
+            old_logits[:, i] = t
+            new_logits[:, i] = wp(pre, t)
     llr, max_llr, min_llr = score.score(old_logits, new_logits)
     query_ids = labels
     unclipped_scores = torch.gather(llr, -1, query_ids.unsqueeze(-1)).squeeze(-1)
@@ -86,35 +111,55 @@ def show_r_llr_score(
     merge_till_displayable=True,
     **kwargs,
 ):
+    return show_r_llr_scores(Model, Tokenizer, [text], compute_range, merge_till_displayable, **kwargs)[0]
+
+
+def show_r_llr_scores(
+    Model,
+    Tokenizer,
+    texts,
+    compute_range=(None, None),
+    merge_till_displayable=True,
+    **kwargs,
+):
+    """Batched show_r_llr_score, runs the LLM once for all texts."""
     n = 10
     dist_qs = [float(i) / n for i in range(n + 1)]
 
     #labels, _, scores = r_llr_score(model_str, [text], dist_qs=dist_qs, **kwargs)
-    labels, _, scores = r_llr_score(Model, Tokenizer, [text], dist_qs=dist_qs, **kwargs)
+    labels, labels_mask, scores = r_llr_score(Model, Tokenizer, texts, dist_qs=dist_qs, **kwargs)
     import numpy as np
 
-    labels = np.array(labels[0].cpu())
-    #print(type(scores[0]))
-    scores = np.array(scores[0].to(torch.float).cpu())
-    if compute_range[0] is None:
-        compute_range = (0, compute_range[1])
-    if compute_range[1] is None:
-        compute_range = (compute_range[0], len(labels))
-    scores[: compute_range[0], :] = 0
-    scores[compute_range[1] :, :] = 0
-    sum_scores = np.sum(scores, axis=0)
-    best_index = np.argmax(sum_scores)
-    res = sum_scores[best_index]
-
-    if res >= 1000:
-        res = 1000
-
-    return float(res)
+    results = []
+    for b_idx in range(len(texts)):
+        # drop the padding of this row
+        length = int(labels_mask[b_idx].sum())
+        row_labels = np.array(labels[b_idx, :length].cpu())
+        #print(type(scores[0]))
+        row_scores = np.array(scores[b_idx, :length].to(torch.float).cpu())
+        row_range = compute_range
+        if row_range[0] is None:
+            row_range = (0, row_range[1])
+        if row_range[1] is None:
+            row_range = (row_range[0], len(row_labels))
+        row_scores[: row_range[0], :] = 0
+        row_scores[row_range[1] :, :] = 0
+        sum_scores = np.sum(row_scores, axis=0)
+        best_index = np.argmax(sum_scores)
+        res = sum_scores[best_index]
+
+        if res >= 1000:
+            res = 1000
+
+        results.append(float(res))
+    return results
 
 class Detector:
-    def __init__(self, model, tokenizer):
+    def __init__(self, model, tokenizer, code_scheme="sha256-v1", memory_budget=None):
         self.model = model
         self.tokenizer = tokenizer
+        self.code_scheme = code_scheme
+        self.memory_budget = memory_budget
         if self.tokenizer.pad_token_id is None:
             self.tokenizer.pad_token = tokenizer.eos_token
 
@@ -126,6 +171,28 @@ class Detector:
                 text=text,
                 show_latex=False,
                 watermark_type="delta",
-                key=b"42"
+                key=b"42",
+                code_scheme=self.code_scheme,
+                memory_budget=self.memory_budget
             )
-        }
\ No newline at end of file
+        }
+
+    def detect_batch(self, texts, batch_size=8):
+        """Detect many texts, filling every LLM forward with batch_size texts."""
+        from ..scheduler import BatchScheduler
+
+        def run_batch(batch_texts):
+            return show_r_llr_scores(
+                Model=self.model,
+                Tokenizer=self.tokenizer,
+                texts=batch_texts,
+                show_latex=False,
+                watermark_type="delta",
+                key=b"42",
+                code_scheme=self.code_scheme,
+                memory_budget=self.memory_budget
+            )
+
+        scheduler = BatchScheduler(batch_size if batch_size else 8, run_batch)
+        scores = scheduler.run([[text] for text in texts])
+        return [{"z_score": score} for (score,) in scores]
\ No newline at end of file
@@ -6,6 +6,7 @@ from torch import FloatTensor, LongTensor
 from torch.nn import functional as F
 
 from . import AbstractWatermarkCode, AbstractReweight, AbstractScore
+from .counterrng import philox_bits
 
 
 class Gamma_WatermarkCode(AbstractWatermarkCode):
@@ -31,6 +32,12 @@ class Gamma_WatermarkCode(AbstractWatermarkCode):
             shuffle = torch.randperm(vocab_size, generator=rng, device=rng.device)
         return cls(shuffle)
 
+    @classmethod
+    def from_keys(cls, keys: LongTensor, vocab_size: int):
+        # sorting i.i.d. 32-bit values gives a uniformly random permutation (up to rare ties, broken by index)
+        shuffle = torch.argsort(philox_bits(keys, vocab_size), dim=-1, stable=True)
+        return cls(shuffle)
+
 
 class Gamma_Reweight(AbstractReweight):
     watermark_code_type = Gamma_WatermarkCode
@@ -17,7 +17,7 @@ class RobustLLR_Score_Batch_Base:
         return len(self.batch_query)
 
     @classmethod
-    def from_grid(cls, dist_ps: npt.ArrayLike, dist_qs: npt.ArrayLike):
+    def from_grid(cls, dist_ps: npt.ArrayLike, dist_qs: npt.ArrayLike, **kwargs):
         dist_ps = np.array(dist_ps)
         dist_qs = np.array(dist_qs)
         assert dist_ps.ndim == 1
@@ -29,7 +29,7 @@ class RobustLLR_Score_Batch_Base:
         dist_p_logs.sort()
         dist_q_logs.sort()
         batch_query = [(d_p_l, d_q_l) for d_p_l in dist_p_logs for d_q_l in dist_q_logs]
-        return cls(batch_query)
+        return cls(batch_query, **kwargs)
 
 
 class RobustLLR_Score_Batch_v1(RobustLLR_Score_Batch_Base):
@@ -139,6 +139,19 @@ def get_max_llr_v1(
 
 
 class RobustLLR_Score_Batch_v2(RobustLLR_Score_Batch_Base):
+    def __init__(self, batch_query, memory_budget: int = None):
+        """memory_budget: if set, bytes of working memory that score may use on top of its outputs. The sequence
+        dimension is then scored in chunks of positions that fit the budget, with identical results."""
+        super().__init__(batch_query)
+        self.memory_budget = memory_budget
+
+    def positions_per_chunk(self, p_logits: FloatTensor) -> int:
+        """Number of positions (of all batch rows) scored at once under memory_budget. get_max_llr_v2 holds about
+        a dozen [..., vocab_size] tensors at its peak (logits, sort index, cumulative sums, modified logits, masks)."""
+        batch_size, vocab_size = p_logits.shape[0], p_logits.shape[-1]
+        bytes_per_position = batch_size * vocab_size * (12 * p_logits.element_size() + 8)
+        return max(1, self.memory_budget // bytes_per_position)
+
     @torch.no_grad()
     def score(
         self, p_logits: FloatTensor, q_logits: FloatTensor
@@ -149,9 +162,49 @@ class RobustLLR_Score_Batch_v2(RobustLLR_Score_Batch_Base):
         max_llr: [batch_size, seq_len, query_size]
         min_llr: [batch_size, seq_len, query_size]
         """
+        if self.memory_budget is not None and p_logits.ndim == 3:
+            return self._score_chunked(p_logits, q_logits)
+        return self._score(p_logits, q_logits)
+
+    @torch.no_grad()
+    def _score_chunked(
+        self, p_logits: FloatTensor, q_logits: FloatTensor
+    ) -> (FloatTensor, FloatTensor, FloatTensor):
+        """score over [batch_size, chunk, vocab_size] slices of the sequence, writing into preallocated outputs.
+        Every position is scored independently, so the results equal the unchunked ones."""
+        batch_size, seq_len, vocab_size = p_logits.shape
+        chunk = min(self.positions_per_chunk(p_logits), seq_len)
+
+        llr = torch.empty_like(p_logits)
+        max_llr = p_logits.new_empty(batch_size, seq_len, self.query_size())
+        min_llr = p_logits.new_empty(batch_size, seq_len, self.query_size())
+        # log-softmax buffers, reused by every chunk
+        p_buffer = p_logits.new_empty(batch_size, chunk, vocab_size)
+        q_buffer = q_logits.new_empty(batch_size, chunk, vocab_size)
+
+        for start in range(0, seq_len, chunk):
+            stop = min(start + chunk, seq_len)
+            p_chunk = torch.log_softmax(p_logits[:, start:stop], dim=-1, out=p_buffer[:, : stop - start])
+            q_chunk = torch.log_softmax(q_logits[:, start:stop], dim=-1, out=q_buffer[:, : stop - start])
+            chunk_llr, chunk_max_llr, chunk_min_llr = self._score_log_probs(p_chunk, q_chunk)
+            llr[:, start:stop] = chunk_llr
+            max_llr[:, start:stop] = chunk_max_llr
+            min_llr[:, start:stop] = chunk_min_llr
+            del chunk_llr, chunk_max_llr, chunk_min_llr
+        return llr, max_llr, min_llr
+
+    @torch.no_grad()
+    def _score(
+        self, p_logits: FloatTensor, q_logits: FloatTensor
+    ) -> (FloatTensor, FloatTensor, FloatTensor):
         q_logits = F.log_softmax(q_logits, dim=-1)
         p_logits = F.log_softmax(p_logits, dim=-1)
+        return self._score_log_probs(p_logits, q_logits)
 
+    @torch.no_grad()
+    def _score_log_probs(
+        self, p_logits: FloatTensor, q_logits: FloatTensor
+    ) -> (FloatTensor, FloatTensor, FloatTensor):
         max_llr = get_max_llr_v2(p_logits, q_logits, self.batch_query)
         min_llr = -get_max_llr_v2(
             q_logits, p_logits, [(q, p) for p, q in self.batch_query]
@@ -175,7 +228,103 @@ def get_max_llr_v2(
     q_logits: FloatTensor,
     batch_query: list[tuple[float, float]],
 ):
-    """require large memeory, but avoid loop in python"""
+    """all queries at once, by bisection of the cut index instead of a pass over the vocabulary per query
+
+    With tokens sorted by decreasing llr, the modified llr at position k is the llr of the modified cumulative
+    distributions, a mediant of the llr of the tokens before k. Once a token's llr drops below it, so do the llrs of
+    all later tokens, so the cut index is the end of a monotone predicate and can be bisected in O(log vocab_size)
+    gathers. Positions where the modified q is -inf never cut, so the search starts at the searchsorted index of
+    dist_q_log in the cumulative q; the one exception, a 0 (nan) modified llr before the first token with nonzero p,
+    is checked separately. Matches get_max_llr_v2_loop, up to the last-ulp rounding differences of elementwise ops
+    evaluated on gathered elements instead of whole rows.
+    """
+
+    # shape = (..., vocab_size)
+    llr = safe_minus(q_logits, p_logits)
+    # shape = (..., vocab_size)
+    try:
+        sort_index = torch.argsort(llr, dim=-1, descending=True)
+    except torch.cuda.OutOfMemoryError as e:
+        #  use cpu instead
+        sort_index = torch.argsort(llr.cpu(), dim=-1, descending=True).to(llr.device)
+    del llr
+
+    p_logits = p_logits.gather(-1, sort_index)
+    q_logits = q_logits.gather(-1, sort_index)
+    del sort_index
+
+    # shape = (..., vocab_size)
+    llr = safe_minus(q_logits, p_logits)
+
+    # shape = (..., vocab_size)
+    sum_q_logits = torch.logcumsumexp(q_logits, dim=-1)
+    sum_p_logits = torch.logcumsumexp(p_logits, dim=-1)
+    del q_logits
+    del p_logits
+
+    vocab_size = llr.shape[-1]
+    # shape = (..., query_size)
+    query_shape = llr.shape[:-1] + (len(batch_query),)
+    dist_p_logs = torch.tensor(
+        [dist_p_log for dist_p_log, dist_q_log in batch_query],
+        device=llr.device,
+        dtype=llr.dtype,
+    ).expand(query_shape)
+    dist_q_logs = torch.tensor(
+        [dist_q_log for dist_p_log, dist_q_log in batch_query],
+        device=llr.device,
+        dtype=llr.dtype,
+    ).expand(query_shape)
+
+    def modified_llr_before(index):
+        """modified llr of the tokens before index (>= 1), i.e. the padded modified llr at index"""
+        sum_q = sum_q_logits.gather(-1, index - 1)
+        sum_p = sum_p_logits.gather(-1, index - 1)
+        modified_q_logits = torch.where(
+            sum_q <= dist_q_logs,
+            torch.tensor(float("-inf"), device=sum_q.device, dtype=sum_q.dtype),
+            sum_q + torch.log(-torch.expm1(dist_q_logs - sum_q)),
+        )
+        modified_p_logits = torch.logaddexp(sum_p, dist_p_logs)
+        return safe_minus(modified_q_logits, modified_p_logits)
+
+    def cuts_at(index):
+        return llr.gather(-1, index.clamp(max=vocab_size - 1)) < modified_llr_before(index)
+
+    # modified q is -inf up to (and including) position start - 1, no cut at index <= start
+    start = torch.searchsorted(sum_q_logits.contiguous(), dist_q_logs.contiguous(), right=True)
+    low = (start + 1).clamp(max=vocab_size)
+    high = torch.full_like(low, vocab_size)
+    # bisection for the first cutting index in [low, vocab_size], vocab_size meaning no cut
+    for _ in range(vocab_size.bit_length()):
+        mid = (low + high) // 2
+        cut = (mid < high) & cuts_at(mid)
+        high = torch.where(cut, mid, high)
+        low = torch.where(cut | (mid >= high), low, mid + 1)
+
+    # before the first token with nonzero p (position first_p), a zero dist_p leaves the modified p at -inf, and a
+    # -inf modified q makes the modified llr nan, i.e. 0: first_p may cut although it is <= start
+    first_p = torch.searchsorted(
+        sum_p_logits.contiguous(),
+        torch.full_like(sum_p_logits[..., :1], float("-inf")),
+        right=True,
+    ).expand(query_shape)
+    early_cut = (first_p >= 1) & (first_p <= start) & (first_p < vocab_size)
+    early_cut &= cuts_at(first_p.clamp(min=1, max=vocab_size - 1))
+    cut_index = torch.where(early_cut, first_p, high)
+
+    # shape = (..., query_size)
+    return modified_llr_before(cut_index)
+
+
+@torch.no_grad()
+def get_max_llr_v2_loop(
+    # shape = (..., vocab_size)
+    p_logits: FloatTensor,
+    q_logits: FloatTensor,
+    batch_query: list[tuple[float, float]],
+):
+    """reference implementation of get_max_llr_v2, with one pass over the vocabulary per query"""
 
     # shape = (..., vocab_size)
     llr = safe_minus(q_logits, p_logits)
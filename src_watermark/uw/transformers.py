@@ -6,6 +6,7 @@ from torch import FloatTensor, LongTensor
 from transformers import LogitsProcessor
 
 from .base import AbstractReweight, AbstractContextCodeExtractor, AbstractScore
+from .counterrng import code_schemes, hash_contexts, private_key_to_int
 
 
 class WatermarkLogitsProcessor(LogitsProcessor):
@@ -15,14 +16,27 @@ class WatermarkLogitsProcessor(LogitsProcessor):
         reweight: AbstractReweight,
         context_code_extractor: AbstractContextCodeExtractor,
         ignore_history=False,
+        code_scheme: str = "sha256-v1",
     ):
+        """code_scheme selects how watermark codes are derived from the contexts. "sha256-v1" hashes every
+        context with sha256 and seeds one torch.Generator per row. "philox-v1" hashes all contexts on-device and
+        draws the codes of the whole batch from a counter-based generator, see counterrng.py. The two schemes produce
+        different codes, generation and detection must use the same one."""
+        if code_scheme not in code_schemes:
+            raise ValueError(f"Unknown code scheme {code_scheme}, choose from {code_schemes}")
         self.private_key = private_key
         self.reweight = reweight
         self.context_code_extractor = context_code_extractor
         self.ignore_history = ignore_history
+        self.code_scheme = code_scheme
         self.cc_history = set()
+        # "philox-v1": keys of the contexts seen so far
+        self.key_history = set()
+        self.private_key_int = private_key_to_int(private_key) if code_scheme == "philox-v1" else None
 
     def __repr__(self):
+        if self.code_scheme != "sha256-v1":
+            return f"WatermarkLogitsProcessor({repr(self.private_key)}, {repr(self.reweight)}, {repr(self.context_code_extractor)}, {repr(self.ignore_history)}, {repr(self.code_scheme)})"
         return f"WatermarkLogitsProcessor({repr(self.private_key)}, {repr(self.reweight)}, {repr(self.context_code_extractor)}, {repr(self.ignore_history)})"
 
     def get_rng_seed(self, context_code: any) -> any:
@@ -39,6 +53,7 @@ class WatermarkLogitsProcessor(LogitsProcessor):
 
     def reset_history(self):
         self.cc_history = set()
+        self.key_history = set()
 
     def _get_codes(self, input_ids: LongTensor):
         batch_size = input_ids.size(0)
@@ -54,18 +69,85 @@ class WatermarkLogitsProcessor(LogitsProcessor):
         )
         return mask, seeds
 
-    def _core(self, input_ids: LongTensor, scores: FloatTensor):
+    def _get_keys(self, input_ids: LongTensor):
+        """Version of _get_codes for the "philox-v1" scheme: counter-based generator keys of all rows, and the mask of
+        rows whose context was seen before (in an earlier call or an earlier row of this batch). The keys are computed
+        on-device, only the history lookup (a set, like cc_history) reads them back."""
+        contexts = self.context_code_extractor.extract_batch(input_ids)
+        keys = hash_contexts(contexts, self.private_key_int)
+        if self.ignore_history:
+            # like the "sha256-v1" scheme, whose history stays empty in this mode
+            return torch.zeros_like(keys, dtype=torch.bool), keys
+        mask = []
+        for key in keys.tolist():
+            mask.append(key in self.key_history)
+            self.key_history.add(key)
+        return torch.tensor(mask, dtype=torch.bool, device=keys.device), keys
+
+    def _get_watermark_code(self, input_ids: LongTensor, vocab_size: int, device: torch.device):
+        """Watermark code of every row and the mask of rows with a repeated context."""
+        if self.code_scheme == "philox-v1":
+            mask, keys = self._get_keys(input_ids)
+            watermark_code = self.reweight.watermark_code_type.from_keys(
+                keys.to(device), vocab_size
+            )
+            return mask.to(device), watermark_code
+
         mask, seeds = self._get_codes(input_ids)
-        rng = [
-            torch.Generator(device=scores.device).manual_seed(seed) for seed in seeds
-        ]
-        mask = torch.tensor(mask, device=scores.device)
-        watermark_code = self.reweight.watermark_code_type.from_random(
-            rng, scores.size(1)
+        rng = [torch.Generator(device=device).manual_seed(seed) for seed in seeds]
+        mask = torch.tensor(mask, device=device)
+        watermark_code = self.reweight.watermark_code_type.from_random(rng, vocab_size)
+        return mask, watermark_code
+
+    def _core(self, input_ids: LongTensor, scores: FloatTensor):
+        mask, watermark_code = self._get_watermark_code(
+            input_ids, scores.size(1), scores.device
         )
         reweighted_scores = self.reweight.reweight_logits(watermark_code, scores)
         return mask, reweighted_scores
 
+    def _get_watermark_code_of_contexts(self, contexts: LongTensor, vocab_size: int, device: torch.device):
+        """Watermark codes for a [num_contexts, context_len] tensor of already extracted contexts, history is ignored."""
+        if self.code_scheme == "philox-v1":
+            keys = hash_contexts(contexts, self.private_key_int)
+            return self.reweight.watermark_code_type.from_keys(keys.to(device), vocab_size)
+
+        seeds = [self.get_rng_seed(context_code.tobytes()) for context_code in contexts.detach().cpu().numpy()]
+        rng = [torch.Generator(device=device).manual_seed(seed) for seed in seeds]
+        return self.reweight.watermark_code_type.from_random(rng, vocab_size)
+
+    def reweight_all_positions(
+        self, input_ids: LongTensor, logits: FloatTensor, positions_per_chunk: int = 64
+    ) -> FloatTensor:
+        """Reweighted logits of all positions of a [batch_size, seq_len, vocab_size] tensor at once: the result at
+        position i equals self(input_ids[:, : i + 1], logits[:, i]) with ignore_history. The contexts of all positions
+        are extracted together and the reweight is applied to [batch_size * positions_per_chunk, vocab_size] blocks."""
+        assert self.ignore_history, "reweight_all_positions scores every position independently, set ignore_history"
+        batch_size, seq_len, vocab_size = logits.shape
+        context_len = getattr(self.context_code_extractor, "n", None)
+        new_logits = torch.empty_like(logits)
+
+        def reweight(contexts: LongTensor, start: int, stop: int):
+            # contexts: [batch_size, stop - start, context_len], one per position in [start, stop)
+            code = self._get_watermark_code_of_contexts(
+                contexts.reshape(-1, contexts.size(-1)), vocab_size, logits.device
+            )
+            p_logits = logits[:, start:stop].reshape(-1, vocab_size)
+            new_logits[:, start:stop] = self.reweight.reweight_logits(code, p_logits).reshape(
+                batch_size, stop - start, vocab_size
+            )
+
+        # prefixes shorter than the context length (or all prefixes, for contexts of unbounded length) one by one
+        num_short = seq_len if context_len is None else min(context_len - 1, seq_len)
+        for i in range(num_short):
+            reweight(self.context_code_extractor.extract_batch(input_ids[:, : i + 1])[:, None], i, i + 1)
+        # all full-length contexts as sliding windows
+        for start in range(num_short, seq_len, positions_per_chunk):
+            stop = min(start + positions_per_chunk, seq_len)
+            windows = input_ids[:, start - context_len + 1 : stop].unfold(1, context_len, 1)
+            reweight(windows, start, stop)
+        return new_logits
+
     def __call__(self, input_ids: LongTensor, scores: FloatTensor) -> FloatTensor:
         mask, reweighted_scores = self._core(input_ids, scores)
         if self.ignore_history:
@@ -112,12 +194,9 @@ class WatermarkLogitsProcessor(LogitsProcessor):
         assert "get_la_score" in dir(
             self.reweight
         ), "Reweight does not support likelihood agnostic detection"
-        mask, seeds = self._get_codes(input_ids)
-        rng = [
-            torch.Generator(device=input_ids.device).manual_seed(seed) for seed in seeds
-        ]
-        mask = torch.tensor(mask, device=input_ids.device)
-        watermark_code = self.reweight.watermark_code_type.from_random(rng, vocab_size)
+        mask, watermark_code = self._get_watermark_code(
+            input_ids, vocab_size, input_ids.device
+        )
         all_scores = self.reweight.get_la_score(watermark_code)
         scores = torch.gather(all_scores, -1, labels.unsqueeze(-1)).squeeze(-1)
         scores = torch.logical_not(mask).float() * scores
@@ -3,16 +3,67 @@ import os
 import json
 import torch
 import random
+import threading
+import collections
 import scipy.stats
 import numpy as np
 import sentence_transformers
 
 from math import sqrt
+from concurrent.futures import ThreadPoolExecutor
 from transformers import LogitsProcessor
 from transformers import BertModel, AutoTokenizer
 from .train_watermark_model import TransformModel
+from ..scheduler import BatchScheduler
 from sentence_transformers import SentenceTransformer
 
+class LRUCache:
+    """Bounded least-recently-used cache with hit/miss counters. A maxsize of 0 disables caching."""
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key):
+        if key in self._data:
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total > 0 else 0.0,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+        }
+
+
 class WatermarkBase:
     def __init__(
         self,
@@ -41,6 +92,9 @@ class WatermarkBase:
     
     def detect(self, text):
         pass
+
+    def detect_batch(self, texts: list[str], batch_size: int = None) -> list[dict]:
+        return [self.detect(text) for text in texts]
     
     def _get_bias(self, input_ids: torch.LongTensor) -> list[int]:
         green_list_ids = self._get_greenlist_ids(input_ids).cpu().numpy()
@@ -48,6 +102,11 @@ class WatermarkBase:
         bias[green_list_ids] = 1
         return bias
 
+    def get_bias_batch(self, input_ids: torch.LongTensor) -> torch.FloatTensor:
+        """Return the [batch_size, vocab_size] bias for every row of input_ids."""
+        batched_bias = np.stack([self._get_bias(input_ids[b_idx]) for b_idx in range(input_ids.shape[0])])
+        return torch.as_tensor(batched_bias, dtype=torch.float32, device=input_ids.device)
+
 
 class WatermarkContext(WatermarkBase):
     def __init__(
@@ -60,6 +119,8 @@ class WatermarkContext(WatermarkBase):
         embedding_model: str = "",
         mapping_file: str = "",
         transform_model_path: str = "transform_model.pth",
+        bias_cache_size: int = 256,
+        embedding_batch_size: int = 32,
     ):
         super().__init__(gamma, delta, target_tokenizer)
         assert embedding_model in ["perceptiveshawty/compositional-bert-large-uncased", "paraphrase-multilingual-mpnet-base-v2"], f"embedding_model {embedding_model} not supported"
@@ -74,11 +135,23 @@ class WatermarkContext(WatermarkBase):
             self.embedding_model = SentenceTransformer(embedding_model)
             self.input_dim = 768
         self.chunk_length = chunk_length
+        self.embedding_batch_size = embedding_batch_size
         self.transform_model = TransformModel(input_dim=self.input_dim)
         self.transform_model.load_state_dict(torch.load(transform_model_path))
         self.transform_model.to(self.device)
         self.transform_model.to(torch.float32)
 
+        # The context sentence only changes when a chunk of `chunk_length` tokens completes, so the
+        # bias of a completed context is cached instead of re-running the embedder on every step.
+        self.bias_cache = LRUCache(bias_cache_size)
+        self.numpy_bias_cache = LRUCache(bias_cache_size)
+        # Biases being computed ahead of time by prefetch_bias, sentence -> (future, row)
+        self._pending = {}
+        self._prefetch_executor = None
+        self._prefetch_stream = None
+        # The embedder (and its tokenizer) is not thread-safe, prefetching runs it on a background thread
+        self._embedder_lock = threading.Lock()
+
         if os.path.exists(mapping_file):
             print(f"Loading mapping from {mapping_file}")
             with open(mapping_file, 'r') as f:
@@ -92,7 +165,14 @@ class WatermarkContext(WatermarkBase):
             with open(mapping_file, 'w') as f:
                 json.dump(self.mapping, f, indent=4)
 
+        # Preload the mapping on the model device so the bias can be gathered without leaving it
+        self.mapping_tensor = torch.as_tensor(self.mapping, dtype=torch.long, device=self.device)
+
     def get_embedding(self, sentence):
+        with self._embedder_lock:
+            return self._get_embedding(sentence)
+
+    def _get_embedding(self, sentence):
         if isinstance(self.embedding_model, sentence_transformers.SentenceTransformer):
             # SentenceTransformer
             emb = self.embedding_model.encode(sentence, show_progress_bar=False, convert_to_tensor=True).to(self.device)
@@ -105,6 +185,24 @@ class WatermarkContext(WatermarkBase):
                 output = self.embedding_model(input_ids)
             return output[0][:, 0, :]
 
+    def get_embeddings(self, sentences: list[str]):
+        """Embed a list of sentences in one padded forward, returns [len(sentences), input_dim]."""
+        with self._embedder_lock:
+            return self._get_embeddings(sentences)
+
+    def _get_embeddings(self, sentences: list[str]):
+        if isinstance(self.embedding_model, sentence_transformers.SentenceTransformer):
+            # SentenceTransformer
+            emb = self.embedding_model.encode(sentences, batch_size=len(sentences), show_progress_bar=False, convert_to_tensor=True)
+            return emb.to(self.device)
+        else:
+            # C-BERT
+            inputs = self.embedding_tokenizer(sentences, return_tensors="pt", padding=True, max_length=512, truncation="longest_first")
+            inputs = inputs.to(self.device)
+            with torch.no_grad():
+                output = self.embedding_model(input_ids=inputs["input_ids"], attention_mask=inputs["attention_mask"])
+            return output[0][:, 0, :]
+
     def get_context_sentence(self, input_ids: torch.LongTensor):
         input_sentence = self.target_tokenizer.decode(input_ids, skip_special_tokens=True)
         input_tokens = self.target_tokenizer.tokenize(input_sentence, add_special_tokens=False)
@@ -126,34 +224,133 @@ class WatermarkContext(WatermarkBase):
         v_minus_mean = np.tanh(1000*v_minus_mean)
         return v_minus_mean
 
+    def scale_vector_torch(self, v: torch.Tensor) -> torch.Tensor:
+        """Torch version of scale_vector, applied on the last dimension."""
+        mean = v.mean(dim=-1, keepdim=True)
+        return torch.tanh(1000 * (v - mean))
+
     def detect(self, text: str = None):
-        word_2d = self.get_text_split(text)
-        all_value = []
-        biases = []
-        for i in range(1, len(word_2d)):
-            context_sentence = self.target_tokenizer.convert_tokens_to_string([tok for group in word_2d[0:i] for tok in group])
+        return self.detect_batch([text])[0]
+
+    def detect_batch(self, texts: list[str], batch_size: int = None) -> list[dict]:
+        """Detect many texts at once. The prefix contexts of all texts are packed into embedder batches of
+        batch_size (default: embedding_batch_size) regardless of which text they come from."""
+        batch_size = batch_size if batch_size else self.embedding_batch_size
+
+        # Every chunk is scored against the context made of all chunks before it
+        documents = []
+        for text in texts:
+            word_2d = self.get_text_split(text)
+            context_sentences = [
+                self.target_tokenizer.convert_tokens_to_string([tok for group in word_2d[0:i] for tok in group])
+                for i in range(1, len(word_2d))
+            ]
+            tokens = [tok for group in word_2d[1:] for tok in group]
+            chunk_index = [i for i, group in enumerate(word_2d[1:]) for _ in group]
+            documents.append((context_sentences, tokens, chunk_index))
+
+        def run_batch(sentences):
+            with torch.no_grad():
+                return self.scale_vector_torch(self.transform_model(self.get_embeddings(sentences)))
+
+        scheduler = BatchScheduler(batch_size, run_batch)
+        similarities = scheduler.run([context_sentences for context_sentences, _, _ in documents])
+
+        results = []
+        for (_, tokens, chunk_index), similarity in zip(documents, similarities):
+            if len(tokens) == 0:
+                results.append({"z_score": np.mean([]), "biases": []})
+                continue
+            # similarity_array[tok_ids] is similarity[chunk, mapping[tok_ids]], gather it for all tokens at once
+            similarity = torch.stack(similarity)
+            token_ids = torch.as_tensor(self.target_tokenizer.convert_tokens_to_ids(tokens), dtype=torch.long, device=self.device)
+            chunk_index = torch.as_tensor(chunk_index, dtype=torch.long, device=self.device)
+            all_value = (-similarity[chunk_index, self.mapping_tensor[token_ids]]).cpu().tolist()
+            results.append({"z_score": np.mean(all_value), "biases": list(zip(tokens, all_value))})
+        return results
+
+    def _get_bias(self, input_ids: torch.LongTensor, context_sentence: str = None) -> list[int]:
+        if context_sentence is None:
+            context_sentence = self.get_context_sentence(input_ids)
+        bias = self.numpy_bias_cache.get(context_sentence)
+        if bias is None:
             context_embedding = self.get_embedding(context_sentence)
-            output = self.transform_model(context_embedding).cpu()[0].detach().numpy()
+            output = self.transform_model(context_embedding).cpu()[0].numpy()
             similarity_array = self.scale_vector(output)[self.mapping]
+            bias = -similarity_array
+            self.numpy_bias_cache.put(context_sentence, bias)
+        return bias
 
-            tokens = word_2d[i]
-            token_ids = self.target_tokenizer.convert_tokens_to_ids(tokens)
+    def _compute_biases(self, sentences: list[str]) -> torch.FloatTensor:
+        """Embed sentences in one forward and return their [len(sentences), vocab_size] biases."""
+        with torch.no_grad():
+            context_embeddings = self.get_embeddings(sentences)
+            outputs = self.transform_model(context_embeddings)
+            return -self.scale_vector_torch(outputs)[:, self.mapping_tensor]
+
+    def _compute_biases_in_background(self, sentences: list[str]) -> torch.FloatTensor:
+        if self._prefetch_stream is None:
+            return self._compute_biases(sentences)
+        with torch.cuda.stream(self._prefetch_stream):
+            biases = self._compute_biases(sentences)
+        self._prefetch_stream.synchronize()
+        # the biases are consumed on the default stream, tell the caching allocator about it
+        biases.record_stream(torch.cuda.default_stream(self.device))
+        return biases
+
+    def prefetch_bias(self, context_sentences: list[str]):
+        """Start computing the biases of context_sentences on a background thread (and a separate CUDA stream on GPU)
+        so that they are ready when get_bias_batch asks for them. Prefetches left over from the previous call are dropped."""
+        self._drop_pending()
+
+        sentences = [sentence for sentence in dict.fromkeys(context_sentences) if sentence not in self.bias_cache]
+        if len(sentences) == 0:
+            return
+        if self._prefetch_executor is None:
+            self._prefetch_executor = ThreadPoolExecutor(max_workers=1)
+            if self.device.type == "cuda":
+                self._prefetch_stream = torch.cuda.Stream(device=self.device)
+        future = self._prefetch_executor.submit(self._compute_biases_in_background, sentences)
+        for idx, sentence in enumerate(sentences):
+            self._pending[sentence] = (future, idx)
+
+    def _drop_pending(self):
+        """Forget the prefetched biases, each pending batch holds a [num_sentences, vocab_size] tensor on the device."""
+        for future, _ in self._pending.values():
+            future.cancel()
+        self._pending = {}
+
+    def get_bias_batch(self, input_ids: torch.LongTensor, context_sentences: list[str] = None) -> torch.FloatTensor:
+        """Batched version of _get_bias: all uncached contexts of the batch go through the embedder and the
+        transform model in a single forward. Scaling and mapping run on the model device, and the cached biases stay
+        there, so no host round-trip is needed. Returns a [batch_size, vocab_size] bias tensor.
+        context_sentences can be passed in (e.g. from a ContextTracker) to skip get_context_sentence."""
+        if context_sentences is None:
+            context_sentences = [self.get_context_sentence(input_ids[b_idx]) for b_idx in range(input_ids.shape[0])]
+
+        batched_bias = [self.bias_cache.get(sentence) for sentence in context_sentences]
+        resolved, missing = {}, {}
+        for sentence, bias in zip(context_sentences, batched_bias):
+            if bias is not None or sentence in resolved or sentence in missing:
+                continue
+            if sentence in self._pending:
+                # computed (or being computed) by prefetch_bias
+                future, idx = self._pending.pop(sentence)
+                resolved[sentence] = future.result()[idx].clone()  # clone, the row would keep the prefetched batch alive
+            else:
+                missing[sentence] = len(missing)
+        # prefetches target the step right after them, the candidates that were not taken are of no further use
+        self._drop_pending()
 
-            for tok, tok_ids in zip(tokens, token_ids):
-                all_value.append(-float(similarity_array[tok_ids]))
-                biases.append((
-                    tok,
-                    -float(similarity_array[tok_ids])
-                ))
+        if len(missing) > 0:
+            new_biases = self._compute_biases(list(missing.keys()))
+            for sentence, idx in missing.items():
+                resolved[sentence] = new_biases[idx].clone()  # clone, the row would keep the whole batch alive
+        for sentence, bias in resolved.items():
+            self.bias_cache.put(sentence, bias)
 
-        return {"z_score": np.mean(all_value), "biases": biases}
-
-    def _get_bias(self, input_ids: torch.LongTensor) -> list[int]:
-        context_sentence = self.get_context_sentence(input_ids)
-        context_embedding = self.get_embedding(context_sentence)
-        output = self.transform_model(context_embedding).cpu()[0].numpy()
-        similarity_array = self.scale_vector(output)[self.mapping]
-        return -similarity_array
+        batched_bias = [resolved[sentence] if bias is None else bias for sentence, bias in zip(context_sentences, batched_bias)]
+        return torch.stack(batched_bias)
 
 class WatermarkWindow(WatermarkBase):
     def __init__(
@@ -164,26 +361,27 @@ class WatermarkWindow(WatermarkBase):
         gamma: float = 0.5,
         delta: float = 2.0,
         hash_key: int = 15485863,
+        greenlist_cache_size: int = 64,
+        greenlist_cache: LRUCache = None,
     ):
         super().__init__(gamma, delta, target_tokenizer)
         self.device = device
         self.rng = torch.Generator(device=device)
         self.hash_key = hash_key
         self.window_size = window_size
+        # Green masks by seed, each is a [vocab_size] bool tensor on the device. A cache can be passed in to share it
+        # between instances, otherwise every instance keeps at most greenlist_cache_size masks (0 disables caching).
+        self.greenlist_cache = greenlist_cache if greenlist_cache is not None else LRUCache(greenlist_cache_size)
 
     def detect(self, text: str = None):
-        input_ids = self.target_tokenizer.encode(text, add_special_tokens=False)
-        count, total = 0, 0
-        t_v_pair = []
-        input_symbols = self.target_tokenizer.convert_ids_to_tokens(input_ids)
-        for i in range(self.window_size, len(input_ids)):
-            greenlist_ids = self._get_greenlist_ids(torch.tensor(input_ids[:i]))
-            if input_ids[i] in greenlist_ids:
-                count += 1
-                t_v_pair.append((input_symbols[i], 1))
-            else:
-                t_v_pair.append((input_symbols[i], 0))
-            total += 1
+        input_ids = torch.tensor(self.target_tokenizer.encode(text, add_special_tokens=False), dtype=torch.long)
+        # windows input_ids[i - window_size : i] of every scored position i >= window_size, seeded in one op
+        windows = input_ids[:-1].unfold(0, self.window_size, 1) if self.window_size > 0 else input_ids[:, None][:, :0]
+        targets = input_ids[self.window_size :]
+        unique_seeds, inverse = self._get_window_seeds(windows).unique(return_inverse=True)
+        green_masks = self._get_green_masks(unique_seeds)
+        count = int(green_masks[inverse.to(self.device), targets.to(self.device)].sum())
+        total = len(targets)
         return {"z_score": (count-(total-count))/total}
 
     def _seed_rng(self, input_ids: torch.LongTensor):
@@ -202,12 +400,127 @@ class WatermarkWindow(WatermarkBase):
         greenlist_ids = vocab_permutation[:greenlist_size]
         return greenlist_ids
 
+    def _get_window_seeds(self, windows: torch.LongTensor) -> torch.LongTensor:
+        """Seeds of _seed_rng for a [num_windows, window_size] tensor of windows, in one op on its device.
+        hash_key * prod % (2**32 - 1) is reduced in int64 without overflow by splitting the product into 16 bit halves."""
+        if self.window_size == 0:
+            return torch.full(windows.shape[:1], self.hash_key, dtype=torch.long, device=windows.device)
+        modulus = 2**32 - 1
+        window_prod = windows.prod(dim=-1) % modulus  # the int64 product wraps exactly like torch.prod(tokens).item()
+        key = self.hash_key % modulus
+        high, low = window_prod >> 16, window_prod & 0xFFFF
+        return ((key * high) % modulus * 2**16 + key * low) % modulus
+
+    def _get_green_masks(self, seeds: torch.LongTensor) -> torch.BoolTensor:
+        """[len(seeds), vocab_size] green masks, permutations are only drawn for seeds missing from the cache."""
+        greenlist_size = int(self.vocab_size * self.gamma)
+        green_masks = []
+        for seed in seeds.tolist():
+            cache_key = (seed, self.vocab_size, greenlist_size, str(torch.device(self.device)))
+            green_mask = self.greenlist_cache.get(cache_key)
+            if green_mask is None:
+                self.rng.manual_seed(seed)
+                vocab_permutation = torch.randperm(self.vocab_size, device=self.device, generator=self.rng)
+                green_mask = torch.zeros(self.vocab_size, dtype=torch.bool, device=self.device)
+                green_mask[vocab_permutation[:greenlist_size]] = True
+                self.greenlist_cache.put(cache_key, green_mask)
+            green_masks.append(green_mask)
+        return torch.stack(green_masks)
+
+    def get_bias_batch(self, input_ids: torch.LongTensor) -> torch.FloatTensor:
+        """Return the [batch_size, vocab_size] bias for every row of input_ids, seeds of all rows are computed together."""
+        windows = input_ids[:, -self.window_size :] if self.window_size > 0 else input_ids[:, :0]
+        green_masks = self._get_green_masks(self._get_window_seeds(windows))
+        return green_masks.to(device=input_ids.device, dtype=torch.float32)
+
+class ContextTracker:
+    """Per-row incremental bookkeeping of the context sentence during generation.
+
+    Instead of decoding and re-tokenizing the whole prefix on every step, the tracker counts how many target
+    tokens have been appended after the prompt and where the last completed chunk ended. The context sentence
+    of a row is only rebuilt (decoded from the generated token ids) when one of its chunks closes. Unlike
+    WatermarkContext.get_context_sentence, the prompt is not part of the context, which matches detection.
+    """
+
+    def __init__(self, tokenizer, chunk_length: int):
+        self.tokenizer = tokenizer
+        self.chunk_length = chunk_length
+        self.prompt_length = None
+        self.prompt_ids = None
+        self.num_target_tokens = []
+        self.chunk_end = []
+        self.context_sentences = []
+
+    def reset(self, input_ids: torch.LongTensor):
+        batch_size = input_ids.shape[0]
+        self.prompt_length = input_ids.shape[1]
+        self.prompt_ids = input_ids.clone()
+        self.num_target_tokens = [0 for _ in range(batch_size)]
+        self.chunk_end = [0 for _ in range(batch_size)]
+        self.context_sentences = ["" for _ in range(batch_size)]
+
+    def _is_new_sequence(self, input_ids: torch.LongTensor) -> bool:
+        if self.prompt_length is None or input_ids.shape[0] != len(self.num_target_tokens):
+            return True
+        # every decoding step appends exactly one token, anything else is a new generate call
+        if input_ids.shape[1] != self.prompt_length + self.num_target_tokens[0] + 1:
+            return True
+        # a new generate call whose prompt happens to have the expected length
+        return not torch.equal(input_ids[:, : self.prompt_length], self.prompt_ids)
+
+    def update(self, input_ids: torch.LongTensor) -> list[str]:
+        """Account for the tokens appended since the last call and return the context sentence of every row."""
+        if self._is_new_sequence(input_ids):
+            self.reset(input_ids)
+            return self.context_sentences
+
+        num_target_tokens = input_ids.shape[1] - self.prompt_length
+        chunk_end = (num_target_tokens // self.chunk_length) * self.chunk_length
+        for b_idx in range(input_ids.shape[0]):
+            self.num_target_tokens[b_idx] = num_target_tokens
+            if chunk_end != self.chunk_end[b_idx]:
+                target_ids = input_ids[b_idx, self.prompt_length : self.prompt_length + chunk_end]
+                self.context_sentences[b_idx] = self.tokenizer.decode(target_ids, skip_special_tokens=True)
+                self.chunk_end[b_idx] = chunk_end
+        return self.context_sentences
+
+
 class WatermarkLogitsProcessor(LogitsProcessor):
 
-    def __init__(self, watermark_base: WatermarkBase, *args, **kwargs):
+    def __init__(
+        self,
+        watermark_base: WatermarkBase,
+        *args,
+        use_numpy_bias: bool = False,
+        track_context: bool = False,
+        prefetch_top_k: int = 0,
+        **kwargs,
+    ):
         self.watermark_base = watermark_base
+        # Legacy per-row NumPy bias path, kept for parity tests against the torch path
+        self.use_numpy_bias = use_numpy_bias
+        # Incremental context tracking for WatermarkContext, see ContextTracker
+        self.context_tracker = None
+        if track_context:
+            assert isinstance(watermark_base, WatermarkContext), "track_context is only supported for WatermarkContext"
+            self.context_tracker = ContextTracker(watermark_base.target_tokenizer, watermark_base.chunk_length)
+        # Number of next-token candidates whose context is embedded ahead of a chunk boundary (0 disables prefetching)
+        self.prefetch_top_k = prefetch_top_k
+        if self.prefetch_top_k > 0:
+            assert self.context_tracker is not None, "prefetch_top_k requires track_context"
+            assert not self.use_numpy_bias, "prefetch_top_k is not supported with use_numpy_bias"
 
     def _bias_logits(self, scores: torch.Tensor, batched_bias: torch.Tensor, greenlist_bias: float) -> torch.Tensor:
+        # Same invalid-value handling as _bias_logits_numpy, but decided on-device so no host sync is forced
+        invalid = torch.isnan(scores).any() | torch.isinf(scores).any() | (scores < 0).any()
+        sanitized_scores = torch.clamp(torch.nan_to_num(scores, nan=0.0, posinf=0.0, neginf=0.0), min=0.0)
+        scores = torch.where(invalid, sanitized_scores, scores)
+
+        # Apply bias
+        scores = scores + batched_bias.to(scores.device) * greenlist_bias
+        return scores
+
+    def _bias_logits_numpy(self, scores: torch.Tensor, batched_bias: torch.Tensor, greenlist_bias: float) -> torch.Tensor:
         # # Debug: Inspect scores before applying bias
         # print("Scores before bias:", scores)
         # print("Any NaNs in scores:", torch.isnan(scores).any())
@@ -234,13 +547,45 @@ class WatermarkLogitsProcessor(LogitsProcessor):
         # print("Any negative values in scores after bias:", (scores < 0).any())
 
         return scores
-    
+
+    def _prefetch_candidates(self, input_ids: torch.LongTensor, scores: torch.FloatTensor):
+        """If the next token closes a chunk, the context of the next step is one of the top candidates appended to the
+        generated tokens. Embed those candidate contexts in the background while the LLM runs its next forward."""
+        tracker = self.context_tracker
+        rows = [b_idx for b_idx in range(input_ids.shape[0]) if (tracker.num_target_tokens[b_idx] + 1) % tracker.chunk_length == 0]
+        if len(rows) == 0:
+            return
+
+        candidates = scores.topk(self.prefetch_top_k, dim=-1).indices.tolist()
+        target_ids = input_ids[:, tracker.prompt_length :].tolist()
+        candidate_sentences = []
+        for b_idx in rows:
+            for candidate in candidates[b_idx]:
+                candidate_sentences.append(tracker.tokenizer.decode(target_ids[b_idx] + [candidate], skip_special_tokens=True))
+        self.watermark_base.prefetch_bias(candidate_sentences)
+
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
-        batched_bias = [None for _ in range(input_ids.shape[0])]
+        context_sentences = self.context_tracker.update(input_ids) if self.context_tracker is not None else None
 
-        for b_idx in range(input_ids.shape[0]):
-            current_bias = self.watermark_base._get_bias(input_ids[b_idx])
-            batched_bias[b_idx] = current_bias
+        if self.use_numpy_bias:
+            batched_bias = [None for _ in range(input_ids.shape[0])]
+
+            for b_idx in range(input_ids.shape[0]):
+                if context_sentences is not None:
+                    current_bias = self.watermark_base._get_bias(input_ids[b_idx], context_sentence=context_sentences[b_idx])
+                else:
+                    current_bias = self.watermark_base._get_bias(input_ids[b_idx])
+                batched_bias[b_idx] = current_bias
+
+            scores = self._bias_logits_numpy(scores=scores, batched_bias=batched_bias, greenlist_bias=self.watermark_base.delta)
+            return scores
 
+        if context_sentences is not None:
+            batched_bias = self.watermark_base.get_bias_batch(input_ids, context_sentences=context_sentences)
+        else:
+            batched_bias = self.watermark_base.get_bias_batch(input_ids)
         scores = self._bias_logits(scores=scores, batched_bias=batched_bias, greenlist_bias=self.watermark_base.delta)
+
+        if self.prefetch_top_k > 0:
+            self._prefetch_candidates(input_ids, scores)
         return scores
\ No newline at end of file